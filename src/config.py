@@ -1,14 +1,20 @@
 import sys
 
-from direct.showbase import AppRunnerGlobal
 import os
-from panda3d.core import ConfigVariableBool
-from panda3d.core import ConfigVariableInt
-from panda3d.core import ConfigVariableDouble
-from panda3d.core import loadPrcFile
-from pandac.PandaModules import Filename
 import logging
 
+try:
+    from direct.showbase import AppRunnerGlobal
+    from panda3d.core import ConfigVariableBool
+    from panda3d.core import ConfigVariableInt
+    from panda3d.core import ConfigVariableDouble
+    from panda3d.core import ConfigVariableString
+    from panda3d.core import loadPrcFile
+    from pandac.PandaModules import Filename
+except ImportError:
+    # batch jobs may run without Panda3d, every setting keeps its default then
+    AppRunnerGlobal = None
+
 logging.basicConfig(level=logging.INFO,
                     format='*(%(threadName)-10s) %(filename)s:%(lineno)-4d %(message)s',)
 
@@ -18,14 +24,17 @@ logging.debug('debug messages working')
 logging.basicConfig(level=logging.ERROR,
                     format='*(%(threadName)-10s) %(filename)s:%(lineno)-4d %(message)s',)
 
-loadPrcFile("config/config.prc")
 # Figure out what directory this program is in.
 MYDIR = os.path.abspath(sys.path[0])
-MYDIR = Filename.fromOsSpecific(MYDIR).getFullpath()
+if AppRunnerGlobal is not None:
+    loadPrcFile("config/config.prc")
+    MYDIR = Filename.fromOsSpecific(MYDIR).getFullpath()
 logging.info(('running from:' + MYDIR))
 
 #http://www.panda3d.org/forums/viewtopic.php?t=10222
-if AppRunnerGlobal.appRunner is None:
+if AppRunnerGlobal is None:
+    RUNTYPE = 'headless'
+elif AppRunnerGlobal.appRunner is None:
     RUNTYPE = 'python'
 else:
     logging.info("dom"+ str(AppRunnerGlobal.appRunner.dom))
@@ -36,6 +45,8 @@ else:
 
 
 def getConfigInt(name, default):
+    if RUNTYPE == 'headless':
+        return default
     output = ConfigVariableInt(name, default).getValue()
     if RUNTYPE != 'python':
         if AppRunnerGlobal.appRunner.getTokenInt(name):
@@ -43,6 +54,8 @@ def getConfigInt(name, default):
     return output
 
 def getConfigBool(name, default):
+    if RUNTYPE == 'headless':
+        return default
     output = ConfigVariableBool(name, default).getValue()
     if RUNTYPE != 'python':
         if AppRunnerGlobal.appRunner.getTokenBool(name):
@@ -50,6 +63,8 @@ def getConfigBool(name, default):
     return output
 
 def getConfigDouble(name, default):
+    if RUNTYPE == 'headless':
+        return default
     output = ConfigVariableDouble(name, default).getValue()
     if RUNTYPE != 'python':
         if AppRunnerGlobal.appRunner.getTokenFloat(name):
@@ -57,6 +72,8 @@ def getConfigDouble(name, default):
     return output
 
 def getConfigString(name, default):
+    if RUNTYPE == 'headless':
+        return default
     output = ConfigVariableString(name, default).getValue()
     if RUNTYPE != 'python':
         if AppRunnerGlobal.appRunner.getToken(name):
@@ -69,10 +86,34 @@ MAX_TERRAIN_HEIGHT = getConfigDouble("max-terrain-height", 300.0)
 TERRAIN_HORIZONTAL_STRETCH = getConfigDouble("terrain-horizontal-stretch", 1.0)
 
 
+# megabytes of recently generated tile heights kept in memory
+HEIGHT_CACHE_SIZE = getConfigInt("height-cache-size", 64)
+# megabytes of tiles out of range kept in memory in case they come back
+TILE_STORAGE_SIZE = getConfigInt("tile-storage-size", 256)
+
 SAVED_HEIGHT_MAPS = getConfigBool("save-height-maps", False)
 SAVED_SLOPE_MAPS = getConfigBool("save-slope-maps", False)
 SAVED_TEXTURE_MAPS = getConfigBool("save-texture-maps", False)
 SAVED_VEGETATION_MAPS = getConfigBool("save-vegetation-maps", False)
+# keeps saved heights, slopes and texture maps in memory mapped region files
+SAVED_REGION_ARCHIVES = getConfigBool("save-region-archives", False)
 
 THREAD_LOAD_TERRAIN = getConfigBool("thread-load-terrain", False)
-BRUTE_FORCE_TILES = getConfigBool("brute-force-tiles", True)
\ No newline at end of file
+TILE_GENERATOR_PROCESSES = getConfigInt("tile-generator-processes", 0)
+# threads preparing tile data, the main thread builds their geometry
+TILE_BUILDER_THREADS = getConfigInt("tile-builder-threads", 1)
+# milliseconds per frame the main thread spends attaching, removing and
+# changing the detail of tiles, at least one of them is done every frame
+TERRAIN_FRAME_BUDGET = getConfigDouble("terrain-frame-budget", 4.0)
+# samples per side of the coarse tiles shown before full tiles, 0 disables
+COARSE_TILE_SIZE = getConfigInt("coarse-tile-size", 0)
+BRUTE_FORCE_TILES = getConfigBool("brute-force-tiles", True)
+# skip noise octaves finer than the level of detail a new tile is shown at
+PRUNE_FAR_OCTAVES = getConfigBool("prune-far-octaves", False)
+# largest height error allowed when interpolating smooth noise octaves, 0 disables
+SPARSE_NOISE_ERROR = getConfigDouble("sparse-noise-error", 0.0)
+# iterations of erosion run on every generated tile, 0 disables
+THERMAL_EROSION_ITERATIONS = getConfigInt("thermal-erosion-iterations", 0)
+HYDRAULIC_EROSION_ITERATIONS = getConfigInt("hydraulic-erosion-iterations", 0)
+# seconds ahead of a moving focus that tiles are prefetched, 0 disables
+TILE_PREFETCH_TIME = getConfigDouble("tile-prefetch-time", 0.0)
\ No newline at end of file
@@ -41,6 +41,8 @@ class Walker(NodePath):
         self.body.setScale(0.25)
         self.body.reparentTo(self)
         self.heightFunction = heightFunction
+        # walkers updated in bulk are put on the ground by clampToGround()
+        self.groundClamped = True
 
 
     def accelerate(self, desiredVelocity, elapsed):
@@ -105,13 +107,28 @@ class Walker(NodePath):
         self.turnBody(desiredHeading, elapsed)
         self.setPos(startpos + self.velocity * elapsed * self.turbo)
         self.animate()
-        self.setZ(self.heightFunction(self.getX(), self.getY()))
+        if self.groundClamped:
+            self.setZ(self.heightFunction(self.getX(), self.getY()))
 
     def getMaxArrivalSpeed(self, distance):
         # speed / acc * 0.5 = stopping distance
         # speed = 2 * acc * distance
         return 2 * self.acceleration * distance
 
+def clampToGround(walkers, elevationsFunction):
+    """Puts every walker on the ground with a single batch height query.
+
+    elevationsFunction takes arrays of x and y, such as
+    Terrain.getElevations().
+
+    """
+    if not walkers:
+        return
+    xs = [walker.getX() for walker in walkers]
+    ys = [walker.getY() for walker in walkers]
+    for walker, z in zip(walkers, elevationsFunction(xs, ys)):
+        walker.setZ(z)
+
 class Player(Walker):
     def __init__(self, heightFunction, x=0, y=0):
         Walker.__init__(self, heightFunction, x, y)
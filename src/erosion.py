@@ -0,0 +1,146 @@
+"""
+erosion.py: This file contains thermal and hydraulic erosion of heightfields.
+
+Both kinds of erosion work on whole numpy arrays, moving material between
+each sample and its four neighbors once per iteration. A sample is therefore
+only affected by samples a few iterations away, so a tile eroded together
+with a wide enough halo of neighboring samples gets exactly the same border
+as its neighbors, without the tiles ever having to wait for each other.
+"""
+__author__ = "Stephen Lujan"
+
+import numpy
+
+# the four neighbors material can move to, as (y, x) offsets
+NEIGHBORS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+
+def shift(array, dy, dx, fill):
+    """Returns an array holding array[y + dy, x + dx] at y, x.
+
+    Positions outside of the array are filled with fill.
+
+    """
+    result = numpy.empty_like(array)
+    result[...] = fill
+    ySize, xSize = array.shape
+    result[max(0, -dy):ySize - max(0, dy), max(0, -dx):xSize - max(0, dx)] = \
+        array[max(0, dy):ySize - max(0, -dy), max(0, dx):xSize - max(0, -dx)]
+    return result
+
+def thermalErosion(heights, iterations, talus, rate=0.5):
+    """Returns heights with material slid down slopes steeper than talus.
+
+    talus is the height difference between neighboring samples that is
+    stable. rate is the share of the excess moved per iteration.
+
+    """
+    heights = numpy.array(heights, numpy.float64)
+    for i in range(iterations):
+        moved = numpy.zeros_like(heights)
+        received = numpy.zeros_like(heights)
+        for dy, dx in NEIGHBORS:
+            # nothing slides off the edges
+            excess = heights - shift(heights, dy, dx, numpy.inf) - talus
+            # a quarter of the rate keeps a sample from sliding below its
+            # neighbors when it is higher than all four of them
+            flow = numpy.maximum(excess, 0.0) * (rate * 0.25)
+            moved += flow
+            received += shift(flow, -dy, -dx, 0.0)
+        heights += received - moved
+    return heights
+
+def hydraulicErosion(heights, iterations, rain=0.01, solubility=0.1,
+                     evaporation=0.3, capacity=0.1):
+    """Returns heights eroded by rain water flowing downhill.
+
+    Each iteration rain falls on every sample and dissolves solubility times
+    its depth of material. The water flows to lower neighbors carrying its
+    sediment, then evaporates and deposits what it can no longer carry,
+    capacity times its depth. Remaining sediment is deposited at the end.
+
+    """
+    heights = numpy.array(heights, numpy.float64)
+    water = numpy.zeros_like(heights)
+    sediment = numpy.zeros_like(heights)
+    for i in range(iterations):
+        water += rain
+        dissolved = water * solubility
+        heights -= dissolved
+        sediment += dissolved
+
+        # water flows towards lower neighbors in proportion to the drop
+        level = heights + water
+        drops = [numpy.maximum(level - shift(level, dy, dx, numpy.inf), 0.0)
+                 for dy, dx in NEIGHBORS]
+        totalDrop = sum(drops)
+        flowing = totalDrop > 0
+        scale = numpy.zeros_like(heights)
+        # a quarter of the drop at most, so the water does not overshoot
+        flow = numpy.minimum(water, totalDrop * 0.25)
+        scale[flowing] = flow[flowing] / totalDrop[flowing]
+        carried = numpy.zeros_like(heights)
+        carried[flowing] = sediment[flowing] * flow[flowing] / water[flowing]
+        carriedScale = numpy.zeros_like(heights)
+        carriedScale[flowing] = carried[flowing] / totalDrop[flowing]
+        water -= flow
+        sediment -= carried
+        for (dy, dx), drop in zip(NEIGHBORS, drops):
+            water += shift(drop * scale, -dy, -dx, 0.0)
+            sediment += shift(drop * carriedScale, -dy, -dx, 0.0)
+
+        water *= 1.0 - evaporation
+        deposited = numpy.maximum(sediment - water * capacity, 0.0)
+        sediment -= deposited
+        heights += deposited
+    return heights + sediment
+
+
+###############################################################################
+#   Erosion
+###############################################################################
+
+class Erosion():
+    """The erosion applied to every generated tile.
+
+    Heights are in [0,1] and distances in samples. Objects are plain python
+    so they can be sent to tile generator processes.
+
+    """
+
+    def __init__(self, thermalIterations=0, hydraulicIterations=0, talus=0.0015,
+                 thermalRate=0.5, rain=0.01, solubility=0.1, evaporation=0.3,
+                 capacity=0.1):
+
+        self.thermalIterations = thermalIterations
+        self.hydraulicIterations = hydraulicIterations
+        self.talus = talus
+        self.thermalRate = thermalRate
+        self.rain = rain
+        self.solubility = solubility
+        self.evaporation = evaporation
+        self.capacity = capacity
+
+    def getParameters(self):
+        """Returns the settings that determine the eroded heights."""
+
+        return (self.thermalIterations, self.hydraulicIterations, self.talus,
+                self.thermalRate, self.rain, self.solubility, self.evaporation,
+                self.capacity)
+
+    def getHalo(self):
+        """Returns how many samples a tile must be extended by on each side.
+
+        The edges of the extended heights erode differently, and the error
+        spreads one sample per thermal iteration. It spreads two samples per
+        hydraulic iteration, as the water leaving a sample depends on all of
+        its neighbors. One more sample leaves a border for taking slopes.
+
+        """
+        return self.thermalIterations + self.hydraulicIterations * 2 + 1
+
+    def erode(self, heights):
+        heights = hydraulicErosion(heights, self.hydraulicIterations, self.rain,
+                                   self.solubility, self.evaporation, self.capacity)
+        return thermalErosion(heights, self.thermalIterations, self.talus,
+                              self.thermalRate)
@@ -0,0 +1,191 @@
+"""
+heightmap.py: This file contains the HeightMap used by the Terrain class.
+
+The HeightMap coverts world x,y coordinates into terrain height and is
+therefore responsible for the appearance of terrain geometry. It depends only
+on numpy so it can be used in worker processes without Panda3d.
+
+Heights are computed by a NoiseGraph. By default it is built from the
+original perlin1 and perlin2 recipe, but any recipe can be plugged in.
+"""
+__author__ = "Stephen Lujan"
+__date__ = "$Oct 27, 2010 4:47:05 AM$"
+
+import logging
+import math
+import numpy
+
+from noisegraph import Noise
+from noisegraph import NoiseGraph
+from perlin import PerlinNoise2
+from perlin import StackedPerlinNoise2
+
+
+###############################################################################
+#   HeightMap
+###############################################################################
+
+class HeightMap():
+    """HeightMap functionally maps any x and y to the appropriate height for realistic terrain.
+
+    recipe is an optional function that takes the HeightMap and returns the
+    output Node of a noise graph with heights in [0,1]. It has to be a module
+    level function so tile generator processes can rebuild the HeightMap.
+
+    """
+
+    def __init__(self, id, flatHeight=0.3, maxError=0.0, recipe=None):
+
+        self.id = id
+        # the overall smoothness/roughness of the terrain
+        self.smoothness = 150
+        # how quickly altitude and roughness shift
+        self.consistency = self.smoothness * 12
+        # for realism the flatHeight should be at or very close to waterHeight
+        self.flatHeight = flatHeight
+        # the error in height allowed when interpolating smooth octaves
+        self.maxError = maxError
+        #creates noise objects that will be used by the getHeight function
+        self.generateNoiseObjects()
+        self.normalize()
+        self.recipe = recipe
+        if recipe:
+            self.graph = NoiseGraph(recipe(self))
+        else:
+            self.graph = NoiseGraph(self.buildGraph())
+
+    def getParameters(self):
+        """Returns the parameters that determine the output of getHeight()."""
+
+        recipeName = self.recipe.__name__ if self.recipe else "default"
+        return (self.id, self.smoothness, self.consistency, self.flatHeight,
+                self.maxError, recipeName)
+
+    def normalize(self):
+        #normalize the range of possible heights to be bounded [0,1]
+        minmax = []
+        for x in range(2):
+            for y in range(2):
+                minmax.append(self.getPrenormalizedHeight(x, y))
+        min = 9999
+        max = -9999
+        for x in minmax:
+            if x < min:
+                min = x
+            if x > max:
+                max = x
+        self.normalizerSub = min
+        self.normalizerMult = 1.0 / (max-min)
+
+        logging.info("height normalized from [" + str(min) + "," + str(max) + "]")
+
+    def generateStackedPerlin(self, perlin, frequency, layers, frequencySpread, amplitudeSpread, id):
+
+        for x in range(layers):
+            scale = frequency / (math.pow(frequencySpread, x))
+            layer = PerlinNoise2(scale, scale, 256, seed=id + x)
+            perlin.addLevel(layer, 1 / (math.pow(amplitudeSpread, x)))
+
+    def generateNoiseObjects(self):
+        """Create perlin noise."""
+
+        # See getHeight() for more details....
+        # where perlin 1 is low terrain will be mostly low and flat
+        # where it is high terrain will be higher and slopes will be exagerrated
+        # increase perlin1 to create larger areas of geographic consistency
+        self.perlin1 = StackedPerlinNoise2()
+        self.generateStackedPerlin(self.perlin1, self.consistency, 4, 2, 2.5, self.id)
+
+        # perlin2 creates the noticeable noise in the terrain
+        # without perlin2 everything would look unnaturally smooth and regular
+        # increase perlin2 to make the terrain smoother
+        self.perlin2 = StackedPerlinNoise2()
+        self.generateStackedPerlin(self.perlin2, self.smoothness, 8, 2, 2.2, self.id + 100)
+
+
+    def buildGraph(self):
+        """Returns the output Node of the default recipe.
+
+        The noise is blended by getPrenormalizedHeight() and normalized to
+        [0,1], just as getHeight() used to do one sample at a time.
+
+        """
+        # A height changes by at most normalizerMult / 2 per unit of perlin1
+        # and normalizerMult / 4 per unit of perlin2. Half of the error
+        # allowed goes to each of them.
+        p1 = (Noise(self.perlin1, 1.0 / self.normalizerMult) + 1) / 2 # low frequency
+        p2 = (Noise(self.perlin2, 2.0 / self.normalizerMult) + 1) / 2 # high frequency
+
+        return (self.getPrenormalizedHeight(p1, p2)-self.normalizerSub) * self.normalizerMult
+
+    def getPrenormalizedHeight(self, p1, p2):
+        """Returns the height at the specified terrain coordinates.
+
+        The input is a value from each of the noise functions
+
+        """
+
+        fh = self.flatHeight
+        # p1 varies what kind of terrain is in the area, p1 alone would be smooth
+        # p2 introduces the visible noise and roughness
+        # when p1 is high the altitude will be high overall
+        # when p1 is close to fh most of the visible noise will be muted
+        return (p1 - fh + (p1 - fh) * (p2 - fh)) / 2 + fh
+        # if p1 = fh, the whole equation simplifies to...
+        # 1. (fh - fh + (fh - fh) * (p2 - fh)) / 2 + fh
+        # 2. ( 0 + 0 * (p2 - fh)) / 2 + fh
+        # 3. (0 + 0 ) / 2 + fh
+        # 4. fh
+        # The important part to understanding the equation is at step 2.
+        # The closer p1 is to fh, the smaller the mutiplier for p2 becomes.
+        # As p2 diminishes, so does the roughness.
+
+    #@pstat
+    def getHeight(self, x, y):
+        """Returns the height at the specified terrain coordinates.
+
+        The values returned should be between 0 and 1 and use the full range.
+        Heights should be the smoothest and flatest at flatHeight.
+
+        """
+        return float(self.graph.getValues(x, y))
+
+    def getHeights(self, xs, ys, spacing=0.0):
+        """Returns an array of heights at the specified terrain coordinates.
+
+        This is the batch version of getHeight(). xs and ys are array-likes of
+        the same shape and the result has that shape as well. Each node of
+        the graph is evaluated over the whole arrays at once instead of once
+        per sample.
+
+        If spacing is given, octaves too fine to show up in geometry with
+        vertices that far apart are skipped.
+
+        """
+        return self.graph.getValues(xs, ys, spacing)
+
+    def getHeightsAndGradients(self, xs, ys, spacing=0.0):
+        """Returns arrays of heights and their partial derivatives dx and dy.
+
+        The gradient is analytic, carried through every node of the graph
+        from the noise, so slopes come for free with the heights instead of
+        needing a second pass over generated geometry. spacing works as in
+        getHeights().
+
+        """
+        return self.graph.getValuesAndGradients(xs, ys, spacing)
+
+    def getGridHeights(self, xs, ys, spacing=0.0):
+        """Returns heights over the grid of the evenly spaced 1d arrays xs, ys.
+
+        The result is indexed [y, x]. Octaves smooth enough are evaluated on
+        a sparse lattice and interpolated cubically, keeping the heights
+        within maxError of getHeights(). spacing works as in getHeights().
+
+        """
+        return self.graph.getGridValues(xs, ys, spacing, self.maxError)
+
+    def getGridHeightsAndGradients(self, xs, ys, spacing=0.0):
+        """Returns heights and gradients over a grid, see getGridHeights()."""
+
+        return self.graph.getGridValuesAndGradients(xs, ys, spacing, self.maxError)
@@ -230,7 +230,7 @@ class World(DirectObject):
         self.accept("8", self.sky.setTime, [0.0])
         self.accept("n", self.sky.toggleNightSkip)
         self.accept("p", self.sky.pause)
-        self.accept("r", self.terrain.initializeHeightMap)
+        self.accept("r", self.terrain.regenerate)
         self.accept("l", self.terrain.toggleWireFrame)
         self.accept("t", self.physics.test) #self.terrain.test)
         self.accept("e", self.toggleEditor)
@@ -253,6 +253,11 @@ class World(DirectObject):
         self.critter2.maxSpeed = 5.0
         self.critter2.setWander(60)
 
+        # critters are put on the ground together after they move
+        self.critters = [self.critter1, self.critter2]
+        for critter in self.critters:
+            critter.groundClamped = False
+
     def _loadPhysics(self):
         self.physics = TerrainPhysics()
 
@@ -299,8 +304,9 @@ class World(DirectObject):
             self.camera.update(deltaX, deltaY)
             
         self.ralph.update(elapsed)
-        self.critter1.update(elapsed)
-        self.critter2.update(elapsed)
+        for critter in self.critters:
+            critter.update(elapsed)
+        clampToGround(self.critters, self.terrain.getElevations)
 
         self.terrain.setShaderInput("camPos", self.camera.camNode.getPos(render))
         self.terrain.setShaderInput("fogColor", self.sky.fog.getColor())
@@ -325,5 +331,6 @@ def launchTerrainDemo():
     logging.info('calling run()...')
     run()
 
-#if __name__ == "__main__":
-launchTerrainDemo()
+# the guard keeps tile generator processes from relaunching the demo
+if __name__ == "__main__":
+    launchTerrainDemo()
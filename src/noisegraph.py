@@ -0,0 +1,343 @@
+"""
+noisegraph.py: This file contains composable noise graphs for height maps.
+
+A noise graph is built from Nodes: noise sources, constants, arithmetic,
+clamps, blends and masks. Nodes combine with the usual + - * operators, so a
+recipe reads like the formula it computes:
+
+    low = (Noise(perlin1) + 1) * 0.5
+    height = Blend(low, low * (Noise(perlin2) + 1) * 0.5, Clamp(low * 4 - 1))
+
+A NoiseGraph compiles the output node once, merging duplicate nodes and
+folding constants. Every node is then evaluated exactly once per call, as one
+numpy operation over all of a tile's samples, and blends and masks skip the
+branches whose weight is zero across the whole tile.
+"""
+__author__ = "Stephen Lujan"
+
+import copy
+import numpy
+
+
+###############################################################################
+#   Samples
+###############################################################################
+
+class Samples():
+    """The coordinates a NoiseGraph is evaluated at, and the results so far.
+
+    With grid set, xs and ys are evenly spaced 1d arrays and the results are
+    indexed [y, x]. Otherwise they are arrays of points of the same shape.
+    With gradient set, every value is a (value, dx, dy) tuple.
+
+    """
+
+    def __init__(self, xs, ys, grid=False, spacing=0.0, maxError=0.0, gradient=False):
+
+        self.xs = numpy.asarray(xs, numpy.float64)
+        self.ys = numpy.asarray(ys, numpy.float64)
+        self.grid = grid
+        # the vertex spacing the samples will be rendered at, see HeightMap
+        self.spacing = spacing
+        # the height error allowed when interpolating noise sparsely
+        self.maxError = maxError
+        self.gradient = gradient
+        self.values = {}
+
+    def get(self, node):
+        """Returns the value of node, evaluating it on first use."""
+
+        value = self.values.get(node)
+        if value is None:
+            value = node.evaluate(self)
+            self.values[node] = value
+        return value
+
+
+def isUniform(value, constant):
+    """Returns True if every sample of an array equals constant."""
+
+    return bool(numpy.all(value == constant))
+
+
+###############################################################################
+#   Node
+###############################################################################
+
+class Node():
+    """The base class of noise graph nodes."""
+
+    def __init__(self, *inputs):
+
+        self.inputs = tuple(toNode(input) for input in inputs)
+
+    def getParameters(self):
+        """Returns the settings that make this node differ from others of its
+        class with the same inputs."""
+
+        return ()
+
+    def evaluate(self, samples):
+        raise NotImplementedError
+
+    def __add__(self, other):
+        return Add(self, other)
+
+    def __radd__(self, other):
+        return Add(other, self)
+
+    def __sub__(self, other):
+        return Subtract(self, other)
+
+    def __rsub__(self, other):
+        return Subtract(other, self)
+
+    def __mul__(self, other):
+        return Multiply(self, other)
+
+    def __rmul__(self, other):
+        return Multiply(other, self)
+
+    def __neg__(self):
+        return Multiply(-1.0, self)
+
+    def __truediv__(self, divisor):
+        return Multiply(self, 1.0 / divisor)
+
+    __div__ = __truediv__
+
+
+def toNode(value):
+    """Returns value as a Node, wrapping numbers in a Constant."""
+
+    if isinstance(value, Node):
+        return value
+    return Constant(value)
+
+
+###############################################################################
+#   Sources
+###############################################################################
+
+class Constant(Node):
+    """The same value everywhere."""
+
+    def __init__(self, value):
+
+        Node.__init__(self)
+        self.value = float(value)
+
+    def getParameters(self):
+        return (self.value,)
+
+    def evaluate(self, samples):
+        if samples.gradient:
+            return self.value, 0.0, 0.0
+        return self.value
+
+
+class Noise(Node):
+    """Samples a noise object such as a StackedPerlinNoise2.
+
+    errorScale converts the height error a graph may make into the error
+    allowed in this noise, ie. it is one over how much the final height
+    changes per unit of this noise at most.
+
+    """
+
+    def __init__(self, noise, errorScale=1.0):
+
+        Node.__init__(self)
+        self.noise = noise
+        self.errorScale = errorScale
+
+    def getParameters(self):
+        return (id(self.noise), self.errorScale)
+
+    def evaluate(self, samples):
+        noise = self.noise
+        minScale = samples.spacing * 2 # smaller features fall between the vertices
+        if samples.grid:
+            return noise.gridNoise(samples.xs, samples.ys, minScale,
+                                   samples.maxError * self.errorScale, samples.gradient)
+        if samples.gradient:
+            return noise.noiseWithGradient(samples.xs, samples.ys, minScale)
+        return noise.noise(samples.xs, samples.ys, minScale)
+
+
+###############################################################################
+#   Arithmetic
+###############################################################################
+
+class Add(Node):
+
+    def evaluate(self, samples):
+        a = samples.get(self.inputs[0])
+        b = samples.get(self.inputs[1])
+        if samples.gradient:
+            return a[0] + b[0], a[1] + b[1], a[2] + b[2]
+        return a + b
+
+
+class Subtract(Node):
+
+    def evaluate(self, samples):
+        a = samples.get(self.inputs[0])
+        b = samples.get(self.inputs[1])
+        if samples.gradient:
+            return a[0] - b[0], a[1] - b[1], a[2] - b[2]
+        return a - b
+
+
+class Multiply(Node):
+    """The product of two inputs.
+
+    The second is skipped if the first is 0, and with gradients only if the
+    first is also flat, since the product rule still needs da * b.
+
+    """
+
+    def evaluate(self, samples):
+        a = samples.get(self.inputs[0])
+        if samples.gradient:
+            if all(isUniform(part, 0.0) for part in a):
+                return a
+        elif isUniform(a, 0.0):
+            return a
+        b = samples.get(self.inputs[1])
+        if samples.gradient:
+            return (a[0] * b[0], a[1] * b[0] + a[0] * b[1],
+                    a[2] * b[0] + a[0] * b[2])
+        return a * b
+
+
+class Clamp(Node):
+    """Limits an input to [low, high]."""
+
+    def __init__(self, source, low=0.0, high=1.0):
+
+        Node.__init__(self, source)
+        self.low = low
+        self.high = high
+
+    def getParameters(self):
+        return (self.low, self.high)
+
+    def evaluate(self, samples):
+        a = samples.get(self.inputs[0])
+        if not samples.gradient:
+            return numpy.clip(a, self.low, self.high)
+        value, dx, dy = a
+        inside = (value > self.low) & (value < self.high)
+        return numpy.clip(value, self.low, self.high), dx * inside, dy * inside
+
+
+###############################################################################
+#   Blends
+###############################################################################
+
+class Blend(Node):
+    """Fades from a where mask is 0 to b where mask is 1.
+
+    The mask is clamped to [0,1]. When it is 0 or 1 across all samples only
+    the branch that shows is evaluated.
+
+    """
+
+    def __init__(self, a, b, mask):
+
+        Node.__init__(self, a, b, Clamp(mask))
+
+    def evaluate(self, samples):
+        gradient = samples.gradient
+        a, b, mask = self.inputs
+        m = samples.get(mask)
+        weight = m[0] if gradient else m
+        if isUniform(weight, 0.0):
+            return samples.get(a)
+        if isUniform(weight, 1.0):
+            return samples.get(b)
+
+        a = samples.get(a)
+        b = samples.get(b)
+        if not gradient:
+            return a + (b - a) * m
+        difference = b[0] - a[0]
+        return (a[0] + difference * m[0],
+                a[1] + (b[1] - a[1]) * m[0] + difference * m[1],
+                a[2] + (b[2] - a[2]) * m[0] + difference * m[2])
+
+
+class Mask(Blend):
+    """Shows source where mask is 1 and 0 where mask is 0."""
+
+    def __init__(self, source, mask):
+
+        Blend.__init__(self, 0.0, source, mask)
+
+
+###############################################################################
+#   NoiseGraph
+###############################################################################
+
+class NoiseGraph():
+    """A compiled graph of Nodes that evaluates to a single output."""
+
+    def __init__(self, output):
+
+        self.output = self._compile(toNode(output), {}, {})
+
+    def _compile(self, node, compiled, canonical):
+        """Returns node with duplicate subgraphs merged and constants folded."""
+
+        if node in compiled:
+            return compiled[node]
+        inputs = tuple(self._compile(input, compiled, canonical) for input in node.inputs)
+        result = copy.copy(node)
+        result.inputs = inputs
+        if inputs and all(isinstance(input, Constant) for input in inputs):
+            result = Constant(result.evaluate(Samples(0.0, 0.0)))
+        key = (result.__class__, result.getParameters(),
+               tuple(id(input) for input in result.inputs))
+        result = canonical.setdefault(key, result)
+        compiled[node] = result
+        return result
+
+    def evaluate(self, samples):
+        """Returns the output at samples, see Samples."""
+
+        samples.values.clear()
+        return samples.get(self.output)
+
+    def getValues(self, xs, ys, spacing=0.0):
+        """Returns the output at arrays of points."""
+
+        return self._broadcast(self.evaluate(Samples(xs, ys, spacing=spacing)), xs, ys)
+
+    def getValuesAndGradients(self, xs, ys, spacing=0.0):
+        """Returns the output at arrays of points and its derivatives."""
+
+        samples = Samples(xs, ys, spacing=spacing, gradient=True)
+        return [self._broadcast(value, xs, ys) for value in self.evaluate(samples)]
+
+    def getGridValues(self, xs, ys, spacing=0.0, maxError=0.0):
+        """Returns the output over the grid of evenly spaced 1d arrays."""
+
+        samples = Samples(xs, ys, True, spacing, maxError)
+        return self._broadcast(self.evaluate(samples), xs, ys, True)
+
+    def getGridValuesAndGradients(self, xs, ys, spacing=0.0, maxError=0.0):
+        """Returns the output over a grid and its derivatives."""
+
+        samples = Samples(xs, ys, True, spacing, maxError, True)
+        return [self._broadcast(value, xs, ys, True) for value in self.evaluate(samples)]
+
+    def _broadcast(self, value, xs, ys, grid=False):
+        # a graph may turn out to be constant over the samples
+        if grid:
+            shape = (numpy.size(ys), numpy.size(xs))
+        else:
+            shape = numpy.shape(xs)
+        if numpy.shape(value) == shape:
+            return value
+        return numpy.zeros(shape) + value
@@ -0,0 +1,337 @@
+"""
+perlin.py: This file contains a numpy implementation of Panda3d's 2d perlin
+noise.
+
+PerlinNoise2 and StackedPerlinNoise2 mirror the Panda3d classes of the same
+name. Given the same table size and seed they build the same permutation
+table and the same random input transform, so they produce the same noise as
+the c++ objects. Unlike the c++ objects they accept whole arrays of
+coordinates, and being plain python objects they can be pickled and sent to
+other processes.
+"""
+__author__ = "Stephen Lujan"
+
+import math
+import numpy
+
+# Measured bound on the error of cubic interpolation of a PerlinNoise2
+# sampled every h units: CUBIC_ERROR * (h / scale) ** 2. The second
+# derivative of the fade curve jumps at every lattice line, so the error only
+# falls quadratically.
+CUBIC_ERROR = 2.0
+
+
+###############################################################################
+#   Cubic interpolation
+###############################################################################
+
+def cubicWeights(size, step):
+    """Returns Catmull-Rom weights and their derivatives as 2d arrays.
+
+    Row i holds the weights of the lattice points for sample i of a row of
+    size samples, with one lattice point every step samples starting one step
+    before sample 0. Multiplying by the weights resamples a lattice to the
+    samples, so a whole grid is interpolated by two matrix products.
+
+    """
+    latticeSize = (size - 1) // step + 4
+    weights = numpy.zeros((size, latticeSize))
+    derivatives = numpy.zeros((size, latticeSize))
+    t = numpy.arange(size) / float(step)
+    k = t.astype(numpy.int64)
+    f = t - k
+    f2 = f * f
+    f3 = f2 * f
+    rows = numpy.arange(size)
+    for j, w, dw in ((0, (-f3 + 2 * f2 - f) / 2, (-3 * f2 + 4 * f - 1) / 2),
+                     (1, (3 * f3 - 5 * f2 + 2) / 2, (9 * f2 - 10 * f) / 2),
+                     (2, (-3 * f3 + 4 * f2 + f) / 2, (-9 * f2 + 8 * f + 1) / 2),
+                     (3, (f3 - f2) / 2, (3 * f2 - 2 * f) / 2)):
+        weights[rows, k + j] = w
+        derivatives[rows, k + j] = dw
+    return weights, derivatives
+
+
+###############################################################################
+#   Mersenne
+###############################################################################
+
+class Mersenne():
+    """The MT19937 generator Panda3d uses to build its noise tables."""
+
+    def __init__(self, seed):
+
+        self.state = [0] * 624
+        self.state[0] = seed & 0xffffffff
+        for i in range(1, 624):
+            previous = self.state[i - 1]
+            self.state[i] = (1812433253 * (previous ^ (previous >> 30)) + i) & 0xffffffff
+        self.index = 624
+
+    def _twist(self):
+        state = self.state
+        for i in range(624):
+            y = (state[i] & 0x80000000) | (state[(i + 1) % 624] & 0x7fffffff)
+            state[i] = state[(i + 397) % 624] ^ (y >> 1)
+            if y & 1:
+                state[i] ^= 0x9908b0df
+        self.index = 0
+
+    def getUint32(self):
+        if self.index >= 624:
+            self._twist()
+        y = self.state[self.index]
+        self.index += 1
+        y ^= y >> 11
+        y ^= (y << 7) & 0x9d2c5680
+        y ^= (y << 15) & 0xefc60000
+        y ^= y >> 18
+        return y
+
+    def getUint31(self):
+        return self.getUint32() >> 1
+
+
+###############################################################################
+#   PerlinNoise2
+###############################################################################
+
+class PerlinNoise2():
+    """Two dimensional perlin noise that can be evaluated over arrays."""
+
+    # the 8 gradients of Panda3d's PerlinNoise2::grad(), the diagonals and
+    # the axes stretched to about the same length
+    gradients = numpy.array([(1, 1), (1, -1), (-1, 1), (-1, -1),
+                            (1.707, 0), (0, 1.707), (-1.707, 0), (0, -1.707)])
+
+    def __init__(self, sx=1.0, sy=1.0, tableSize=256, seed=0):
+
+        if seed == 0:
+            seed = numpy.random.randint(1, 0x7fffffff)
+        self.tableSize = tableSize
+        self.tableSizeMask = tableSize - 1
+        self.seed = seed
+        self.mersenne = Mersenne(seed)
+
+        # The index table is a randomly shuffled index table doubled up to
+        # avoid modulo computation when hashing neighboring corners.
+        index = list(range(tableSize))
+        for i in range(tableSize):
+            j = self.randomInt(tableSize)
+            index[i], index[j] = index[j], index[i]
+        self.index = numpy.array(index + index, numpy.int64)
+
+        # A random rotation and translation move the singularities on the
+        # axes and at the origin somewhere unpredictable.
+        angle = math.radians(self.randomReal(360.0))
+        c = math.cos(angle)
+        s = math.sin(angle)
+        # the c++ compiler draws the y translation before the x translation
+        ty = self.randomReal(1.0) - 0.5
+        tx = self.randomReal(1.0) - 0.5
+        self.unscaledXform = numpy.array([(c, s, 0.0),
+                                         (-s, c, 0.0),
+                                         (tx, ty, 1.0)])
+        self.setScale(sx, sy)
+
+    def randomInt(self, range):
+        return int(self.randomReal(range))
+
+    def randomReal(self, range):
+        return (range * self.mersenne.getUint31()) / float(0x80000000)
+
+    def setScale(self, sx, sy=None):
+        """Sets the size of the noise features in input units."""
+
+        if sy == None:
+            sy = sx
+        # the smallest feature size, used to skip octaves too fine to sample
+        self.scale = min(sx, sy)
+        scale = numpy.array([(1.0 / sx, 0.0, 0.0),
+                            (0.0, 1.0 / sy, 0.0),
+                            (0.0, 0.0, 1.0)])
+        self.inputXform = numpy.dot(scale, self.unscaledXform)
+
+    def noise(self, x, y):
+        """Returns the noise at x, y, which may be scalars or arrays."""
+
+        return self._evaluate(x, y, False)
+
+    def noiseWithGradient(self, x, y):
+        """Returns the noise at x, y and its partial derivatives dx and dy."""
+
+        return self._evaluate(x, y, True)
+
+    def _evaluate(self, x, y, gradient):
+        x = numpy.asarray(x, numpy.float64)
+        y = numpy.asarray(y, numpy.float64)
+        m = self.inputXform
+        # convert the coordinates to our local coordinate space
+        vx = x * m[0, 0] + y * m[1, 0] + m[2, 0]
+        vy = x * m[0, 1] + y * m[1, 1] + m[2, 1]
+
+        # find the unit square that contains each point
+        xf = numpy.floor(vx)
+        yf = numpy.floor(vy)
+        X = xf.astype(numpy.int64) & self.tableSizeMask
+        Y = yf.astype(numpy.int64) & self.tableSizeMask
+
+        # relative position of each point in its square
+        vx = vx - xf
+        vy = vy - yf
+        u = vx * vx * (3 - 2 * vx)
+        v = vy * vy * (3 - 2 * vy)
+
+        # hash coordinates of the 4 square corners
+        index = self.index
+        A = index[X] + Y
+        B = index[X + 1] + Y
+        gradients = self.gradients
+        h00 = gradients[index[A] & 7]
+        h10 = gradients[index[B] & 7]
+        h01 = gradients[index[A + 1] & 7]
+        h11 = gradients[index[B + 1] & 7]
+
+        g00 = vx * h00[..., 0] + vy * h00[..., 1]
+        g10 = (vx - 1) * h10[..., 0] + vy * h10[..., 1]
+        g01 = vx * h01[..., 0] + (vy - 1) * h01[..., 1]
+        g11 = (vx - 1) * h11[..., 0] + (vy - 1) * h11[..., 1]
+
+        low = g00 + u * (g10 - g00)
+        high = g01 + u * (g11 - g01)
+        result = low + v * (high - low)
+        if not gradient:
+            if result.ndim == 0:
+                return float(result)
+            return result
+
+        # derivatives of the fade curves
+        du = 6 * vx * (1 - vx)
+        dv = 6 * vy * (1 - vy)
+        # derivatives of the lerps with respect to the local coordinates
+        lowX = h00[..., 0] + u * (h10[..., 0] - h00[..., 0]) + du * (g10 - g00)
+        highX = h01[..., 0] + u * (h11[..., 0] - h01[..., 0]) + du * (g11 - g01)
+        lowY = h00[..., 1] + u * (h10[..., 1] - h00[..., 1])
+        highY = h01[..., 1] + u * (h11[..., 1] - h01[..., 1])
+        localX = lowX + v * (highX - lowX)
+        localY = lowY + v * (highY - lowY) + dv * (high - low)
+        # and back to the input coordinate space
+        dx = localX * m[0, 0] + localY * m[0, 1]
+        dy = localX * m[1, 0] + localY * m[1, 1]
+        if result.ndim == 0:
+            return float(result), float(dx), float(dy)
+        return result, dx, dy
+
+    def gridNoise(self, xs, ys, step=1, gradient=False):
+        """Returns the noise over the grid of the 1d coordinate arrays xs, ys.
+
+        The result is indexed [y, x] and the coordinates must be evenly
+        spaced. With a step above 1 the noise is only evaluated every step
+        samples and interpolated cubically in between.
+
+        """
+        xs = numpy.asarray(xs, numpy.float64)
+        ys = numpy.asarray(ys, numpy.float64)
+        if step <= 1 or len(xs) < 2 or len(ys) < 2:
+            x, y = numpy.meshgrid(xs, ys)
+            return self._evaluate(x, y, gradient)
+
+        xWeights, xDerivatives = cubicWeights(len(xs), step)
+        yWeights, yDerivatives = cubicWeights(len(ys), step)
+        xSpacing = (xs[1] - xs[0]) * step
+        ySpacing = (ys[1] - ys[0]) * step
+        x, y = numpy.meshgrid(xs[0] + (numpy.arange(xWeights.shape[1]) - 1) * xSpacing,
+                              ys[0] + (numpy.arange(yWeights.shape[1]) - 1) * ySpacing)
+        lattice = self._evaluate(x, y, False)
+        result = numpy.dot(numpy.dot(yWeights, lattice), xWeights.T)
+        if not gradient:
+            return result
+        dx = numpy.dot(numpy.dot(yWeights, lattice), xDerivatives.T) / xSpacing
+        dy = numpy.dot(numpy.dot(yDerivatives, lattice), xWeights.T) / ySpacing
+        return result, dx, dy
+
+    def getLatticeStep(self, spacing, maxError):
+        """Returns how many samples apart the noise may be evaluated.
+
+        spacing is the distance between samples. The step keeps the error of
+        gridNoise() below maxError.
+
+        """
+        if maxError <= 0 or spacing <= 0:
+            return 1
+        latticeSpacing = self.scale * math.sqrt(maxError / CUBIC_ERROR)
+        return max(1, int(latticeSpacing / spacing))
+
+    def __call__(self, x, y):
+        return self.noise(x, y)
+
+
+###############################################################################
+#   StackedPerlinNoise2
+###############################################################################
+
+class StackedPerlinNoise2():
+    """A weighted sum of PerlinNoise2 levels, like Panda3d's version."""
+
+    def __init__(self):
+
+        self.levels = []
+
+    def addLevel(self, level, amp=1.0):
+        self.levels.append((level, amp))
+
+    def getNumLevels(self):
+        return len(self.levels)
+
+    def noise(self, x, y, minScale=0.0):
+        """Returns the noise at x, y, which may be scalars or arrays.
+
+        Levels with features smaller than minScale are skipped.
+
+        """
+        result = 0.0
+        for level, amp in self.levels:
+            if level.scale >= minScale:
+                result = result + level.noise(x, y) * amp
+        return result
+
+    def noiseWithGradient(self, x, y, minScale=0.0):
+        """Returns the noise at x, y and its partial derivatives dx and dy."""
+
+        result = dx = dy = 0.0
+        for level, amp in self.levels:
+            if level.scale < minScale:
+                continue
+            value, levelDx, levelDy = level.noiseWithGradient(x, y)
+            result = result + value * amp
+            dx = dx + levelDx * amp
+            dy = dy + levelDy * amp
+        return result, dx, dy
+
+    def gridNoise(self, xs, ys, minScale=0.0, maxError=0.0, gradient=False):
+        """Returns the noise over the grid of the 1d coordinate arrays xs, ys.
+
+        Levels smooth enough to stay within maxError, which is shared out
+        evenly between the levels, are sampled sparsely and interpolated.
+        See PerlinNoise2.gridNoise().
+
+        """
+        xs = numpy.asarray(xs, numpy.float64)
+        spacing = abs(xs[1] - xs[0]) if len(xs) > 1 else 0.0
+        levels = [(level, amp) for level, amp in self.levels if level.scale >= minScale]
+        result = dx = dy = 0.0
+        for level, amp in levels:
+            step = level.getLatticeStep(spacing, maxError / (amp * len(levels)))
+            if not gradient:
+                result = result + level.gridNoise(xs, ys, step) * amp
+                continue
+            value, levelDx, levelDy = level.gridNoise(xs, ys, step, True)
+            result = result + value * amp
+            dx = dx + levelDx * amp
+            dy = dy + levelDy * amp
+        if not gradient:
+            return result
+        return result, dx, dy
+
+    def __call__(self, x, y):
+        return self.noise(x, y)
@@ -4,7 +4,6 @@ populator.py: This file contains code to populate terrain tiles with objects
 __author__ = "Stephen Lujan"
 
 from terraintile import *
-from direct.showbase.RandomNumGen import *
 from pandac.PandaModules import TextNode, CardMaker
 from pandac.PandaModules import Vec3,Vec4,Point3,Point2
 from pandac.PandaModules import Shader, Texture, TextureStage, TransparencyAttrib
@@ -51,9 +50,13 @@ class LeafModel():
 
 copy = NodePath()
 
-tree = LeafModel("Tree 1", 3, 5.0, 5.0, None, 'Bleech.png', None)
+# models are loaded on first use, so importing this file needs no ShowBase
+tree = None
 
 def makeTree():
+    global tree
+    if tree is None:
+        tree = LeafModel("Tree 1", 3, 5.0, 5.0, None, 'Bleech.png', None)
     np = tree.np.copyTo( copy )
     #np = self.model.instanceTo( self.grassNP )
     #np = loader.loadModel( 'models/grass.egg' )
@@ -64,9 +67,12 @@ def makeTree():
     #logging.info( np)
     return np
 
-sphere = loader.loadModel("models/sphere")
+sphere = None
 
 def makeSphere():
+    global sphere
+    if sphere is None:
+        sphere = loader.loadModel("models/sphere")
     np = NodePath()
     sphere.copyTo( np )
     #np = self.model.instanceTo( self.grassNP )
@@ -94,25 +100,29 @@ class TerrainPopulator():
         self.factories.append(factory)
 
     def populate(self, tile):
-        terrain = tile.terrain
-        xOff = tile.xOffset
-        yOff = tile.yOffset
-        tileSize = terrain.tileSize
-
-        seed = terrain.heightMap.getHeight(yOff * -2, xOff * -2)+1 * 2147483647
-        dice = RandomNumGen(seed)
-
-        for factory in self.factories:
-            #num = dice.randint(0, factory.averageNumber) + dice.randint(0, factory.averageNumber)
-            num = int((dice.random() + dice.random()) * factory.averageNumber)
-            for iterator in range(num):
-                x = dice.random() * tileSize
-                y = dice.random() * tileSize
-                if terrain.getHeight(x+xOff, y+yOff) > terrain.waterHeight:
-                    object = factory.factoryFunction(*factory.constructorParams)
-                    #logging.info( object)
-                    #logging.info( factory.factoryFunction)
-                    self.addToTile(tile, object, x, y)
+        self.addObjects(tile, self.placeObjects(tile))
+
+    def placeObjects(self, tile):
+        """Returns where objects go on a tile as (factory, x, y) tuples.
+
+        This only reads the tile's heights, so it can run on any thread. The
+        placements are made by TerrainWorld.placeObjects(), which headless
+        generation uses as well.
+
+        """
+        averageNumbers = [factory.averageNumber for factory in self.factories]
+        placements = tile.world.placeObjects(tile.xOffset, tile.yOffset, tile.heights,
+                                             averageNumbers, tile.heightMapDetail)
+        return [(self.factories[kind], x, y) for kind, x, y in placements]
+
+    def addObjects(self, tile, placements):
+        """Makes the objects placed by placeObjects() on the main thread."""
+
+        for factory, x, y in placements:
+            object = factory.factoryFunction(*factory.constructorParams)
+            #logging.info( object)
+            #logging.info( factory.factoryFunction)
+            self.addToTile(tile, object, x, y)
         tile.statics.flattenStrong()
 
     def addToTile(self, tile, object, x, y):
@@ -122,7 +132,7 @@ class TerrainPopulator():
         object.reparentTo(tile.statics)
         #z = tile.terrain.getElevation(x + tile.xOffset, y + tile.yOffset)
         #print z
-        z = tile.terrain.getHeight(x + tile.xOffset, y + tile.yOffset)
+        z = tile.getLocalHeight(x, y)
         #print z
         object.setPos(render, x + tile.xOffset, y + tile.yOffset, z)
         #object.setScale(100.0)
@@ -16,19 +16,22 @@ __author__ = "Stephen Lujan"
 __date__ = "$Oct 27, 2010 4:47:05 AM$"
 
 import math
+import numpy
+import time
 
+from collections import OrderedDict
 from collections import deque
 from config import *
 from direct.showbase.RandomNumGen import *
 from direct.task.Task import Task
+from erosion import Erosion
+from heightmap import *
 from panda3d.core import BitMask32
 from panda3d.core import CollisionHandlerQueue
 from panda3d.core import CollisionNode
 from panda3d.core import CollisionRay
 from panda3d.core import CollisionTraverser
 from panda3d.core import PNMImage
-from panda3d.core import PerlinNoise2
-from panda3d.core import StackedPerlinNoise2
 from panda3d.core import TimeVal
 from pandac.PandaModules import NodePath
 from pandac.PandaModules import PTAFloat
@@ -37,6 +40,12 @@ from populator import *
 from pstat_debug import pstat
 from terraintexturer import *
 from terraintile import *
+from terrainworld import TerrainWorld
+from tilecache import HeightCache
+from tilecache import TileStorage
+from tilecache import groupByCell
+from tilegenerator import TileGeneratorPool
+from tileregion import TEXTURE_LAYER
 
 """
     Panda3d GeoMipTerrain tips:
@@ -54,102 +63,62 @@ in adding and removing tiles is trivial in practice.
 """
 
 
-###############################################################################
-#   HeightMap
-###############################################################################
+def ringOffsets(tileSize, radius):
+    """Returns the offsets of the tiles around a tile, closest first.
 
-class HeightMap():
-    """HeightMap functionally maps any x and y to the appropriate height for realistic terrain."""
-
-    def __init__(self, id, flatHeight=0.3):
-
-        self.id = id
-        # the overall smoothness/roughness of the terrain
-        self.smoothness = 150
-        # how quickly altitude and roughness shift
-        self.consistency = self.smoothness * 12
-        # for realism the flatHeight should be at or very close to waterHeight
-        self.flatHeight = flatHeight
-        #creates noise objects that will be used by the getHeight function
-        self.generateNoiseObjects()
-        self.normalize()
-
-    def normalize(self):
-        #normalize the range of possible heights to be bounded [0,1]
-        minmax = []
-        for x in range(2):
-            for y in range(2):
-                minmax.append(self.getPrenormalizedHeight(x, y))
-        min = 9999
-        max = -9999
-        for x in minmax:
-            if x < min:
-                min = x
-            if x > max:
-                max = x
-        self.normalizerSub = min
-        self.normalizerMult = 1.0 / (max-min)
-
-        logging.info("height normalized from [" + str(min) + "," + str(max) + "]")
-
-    def generateStackedPerlin(self, perlin, frequency, layers, frequencySpread, amplitudeSpread, id):
-
-        for x in range(layers):
-            layer = PerlinNoise2(0, 0, 256, seed=id + x)
-            layer.setScale(frequency / (math.pow(frequencySpread, x)))
-            perlin.addLevel(layer, 1 / (math.pow(amplitudeSpread, x)))
-
-    def generateNoiseObjects(self):
-        """Create perlin noise."""
-
-        # See getHeight() for more details....
-        # where perlin 1 is low terrain will be mostly low and flat
-        # where it is high terrain will be higher and slopes will be exagerrated
-        # increase perlin1 to create larger areas of geographic consistency
-        self.perlin1 = StackedPerlinNoise2()
-        self.generateStackedPerlin(self.perlin1, self.consistency, 4, 2, 2.5, self.id)
-
-        # perlin2 creates the noticeable noise in the terrain
-        # without perlin2 everything would look unnaturally smooth and regular
-        # increase perlin2 to make the terrain smoother
-        self.perlin2 = StackedPerlinNoise2()
-        self.generateStackedPerlin(self.perlin2, self.smoothness, 8, 2, 2.2, self.id + 100)
-
-
-    def getPrenormalizedHeight(self, p1, p2):
-        """Returns the height at the specified terrain coordinates.
-
-        The input is a value from each of the noise functions
+    Offsets are multiples of tileSize. Only tiles whose center may be within
+    radius of a point somewhere on the center tile are included.
 
-        """
+    """
+    # the focus can be half a tile diagonal away from the center of its tile
+    reach = radius + tileSize * 0.71
+    steps = int(reach / tileSize) + 1
+    offsets = []
+    for x in range(-steps, steps + 1):
+        for y in range(-steps, steps + 1):
+            distanceSq = (x * x + y * y) * tileSize * tileSize
+            if distanceSq < reach * reach:
+                offsets.append((distanceSq, x * tileSize, y * tileSize))
+    offsets.sort()
+    return [(x, y) for distanceSq, x, y in offsets]
 
-        fh = self.flatHeight
-        # p1 varies what kind of terrain is in the area, p1 alone would be smooth
-        # p2 introduces the visible noise and roughness
-        # when p1 is high the altitude will be high overall
-        # when p1 is close to fh most of the visible noise will be muted
-        return (p1 - fh + (p1 - fh) * (p2 - fh)) / 2 + fh
-        # if p1 = fh, the whole equation simplifies to...
-        # 1. (fh - fh + (fh - fh) * (p2 - fh)) / 2 + fh
-        # 2. ( 0 + 0 * (p2 - fh)) / 2 + fh
-        # 3. (0 + 0 ) / 2 + fh
-        # 4. fh
-        # The important part to understanding the equation is at step 2.
-        # The closer p1 is to fh, the smaller the mutiplier for p2 becomes.
-        # As p2 diminishes, so does the roughness.
-
-    #@pstat
-    def getHeight(self, x, y):
-        """Returns the height at the specified terrain coordinates.
 
-        The values returned should be between 0 and 1 and use the full range.
-        Heights should be the smoothest and flatest at flatHeight.
+###############################################################################
+#   TerrainFocus
+###############################################################################
 
-        """
-        p1 = (self.perlin1(x, y) + 1) / 2 # low frequency
-        p2 = (self.perlin2(x, y) + 1) / 2 # high frequency
+class TerrainFocus():
+    """A NodePath the terrain keeps tiles loaded around.
+
+    Tiles are made within minTileDistance of the focus, and kept while its
+    tile is within maxTileDistance of them. Distances are in the terrain's
+    tile units.
+
+    """
+
+    def __init__(self, terrain, nodePath, maxRange):
+
+        self.nodePath = nodePath
+        self.maxRange = maxRange
+        tileSize = terrain.tileSize
+        self.minTileDistance = maxRange / terrain.horizontalScale + tileSize / 2
+        self.maxTileDistance = self.minTileDistance + tileSize / 2
+        # tiles to check in Terrain.makeNewTile(), in order around the focus tile
+        self.searchOffsets = ringOffsets(tileSize, self.minTileDistance)
+        self.searchOrigin = None
+        self.searchOrder = []
+        # searchOrder is known to be loaded up to this index
+        self.searchStart = 0
+        # the tiles kept around the focus tile and its predicted tile, see
+        # Terrain.updateTileReferences()
+        self.keepOffsets = ringOffsets(tileSize, self.maxTileDistance)
+        self.references = set()
+        # the tiles of the focus and of its predicted position when the
+        # tiles were last checked, see Terrain.checkFocus()
+        self.tiles = None
+        # the position of the focus when tile details were last checked
+        self.lodPosition = None
 
-        return (self.getPrenormalizedHeight(p1, p2)-self.normalizerSub) * self.normalizerMult
 
 ###############################################################################
 #   Terrain
@@ -175,7 +144,16 @@ class Terrain(NodePath):
         # stores all terrain tiles that make up the terrain
         self.tiles = {}
         # stores previously built tiles we can readd to the terrain
-        self.storage = {}
+        self.storage = TileStorage(TILE_STORAGE_SIZE * 1024 * 1024, self.evictTile)
+        # coarse tiles waiting to be replaced by full tiles
+        self.refineQueue = deque()
+        # maintenance carried over to later frames, see update()
+        self.removalQueue = deque()
+        self.lodChanges = OrderedDict()
+        self.maintenance = [self.removeOldTile, self.grabBuiltTile,
+                            self.changeTileDetail, self.makeNewTile, self.refineTile,
+                            self.buildPendingTile]
+        self.maintenanceIndex = 0
         self.feedBackString = feedBackString
         if populator == None:
             populator = TerrainPopulator()
@@ -183,14 +161,18 @@ class Terrain(NodePath):
 
         self.graphReducer = SceneGraphReducer()
 
-        if THREAD_LOAD_TERRAIN:
-            self.tileBuilder = TerrainTileBuilder(self)
-
         ##### Terrain Tile physical properties
         self.maxHeight = MAX_TERRAIN_HEIGHT
         self.tileSize = 128
         self.heightMapSize = self.tileSize + 1
 
+        # worker processes generating tile heights for the tile builder
+        self.generatorPool = None
+        if THREAD_LOAD_TERRAIN:
+            if TILE_GENERATOR_PROCESSES > 0:
+                self.generatorPool = TileGeneratorPool(self.tileSize, TILE_GENERATOR_PROCESSES)
+            self.tileBuilder = TerrainTileBuilder(self)
+
         ##### Terrain scale and tile distances
         # distances are measured in tile's smallest unit
         # conversion to world units may be necessary
@@ -212,12 +194,36 @@ class Terrain(NodePath):
         # to avoid excessive store / retrieve behavior on tiles we have a small
         # buffer where it doesn't matter whether or not the tile is present
         self.maxTileDistance = self.minTileDistance + self.tileSize / 2
+        # set when makeNewTile() may find a missing tile
+        self.tilesMissing = True
+        # whether tile details must be checked regardless of focus movement
+        self.lodDirty = True
+        # the points tiles are loaded around, the first one is self.focus
+        self.foci = []
+        # the number of foci keeping each tile position loaded
+        self.tileReferences = {}
+        self.addFocus(focus, maxRange)
 
         ##### heightmap properties
+        # recently generated tile heights, consulted before evaluating noise
+        self.heightCache = HeightCache(HEIGHT_CACHE_SIZE * 1024 * 1024)
+        # a function building a noisegraph for the HeightMap, None for default
+        self.heightMapRecipe = None
+        self.erosion = None
+        if THERMAL_EROSION_ITERATIONS or HYDRAULIC_EROSION_ITERATIONS:
+            self.erosion = Erosion(THERMAL_EROSION_ITERATIONS, HYDRAULIC_EROSION_ITERATIONS)
+        # a world being built by regenerate(), its finished tiles, the
+        # positions it needs before the swap and those left to build when
+        # not threaded
+        self.pendingWorld = None
+        self.pendingTiles = {}
+        self.pendingPositions = []
+        self.pendingQueue = deque()
         self.initializeHeightMap(id)
 
         ##### rendering properties
         self.initializeRenderingProperties()
+        self.initializeRegionStore()
 
         ##### task handling
         #self._setupThreadedTasks()
@@ -234,22 +240,167 @@ class Terrain(NodePath):
         #self.flattenLight()
 
     def initializeHeightMap(self, id=0):
-        """ """
+        """Replaces the world at once with a new one for seed id.
+
+        Every tile is removed, so the terrain stays empty until tiles of the
+        new world are built. See regenerate() for a seamless replacement.
 
+        """
         logging.info("initializing heightmap...")
 
+        #Remove old tiles that will not conform to a new heightmap
+        for pos, tile in self.tiles.items():
+            self.deleteTile(pos)
+        self.storage.clear()
+        self.cancelRegeneration()
+
+        self.setWorld(self.createWorld(id))
+        if hasattr(self, "texturer"):
+            self.initializeRegionStore()
+
+    def chooseId(self, id=0):
+        """Returns id, or a random one if it is 0."""
+
         if id == 0:
             self.dice = RandomNumGen(TimeVal().getUsec())
             id = self.dice.randint(2, 1000000)
-        self.id = id
+        return id
+
+    def createWorld(self, id=0):
+        """Returns a TerrainWorld for seed id with this terrain's properties."""
+
+        return TerrainWorld(self.chooseId(id), self.tileSize, self.maxHeight,
+                            self.waterHeight, self.heightMapRecipe, self.erosion,
+                            self.heightCache, SPARSE_NOISE_ERROR)
+
+    def setWorld(self, world):
+        """Makes world the one new tiles are built for and heights come from."""
+
+        self.world = world
+        self.id = world.id
+        self.heightMap = world.heightMap
+        self.getHeight = world.getHeight
+        self.getHeights = world.getHeights
+        self.getHeightsAndGradients = world.getHeightsAndGradients
+        self.getGridHeights = world.getGridHeights
+        self.getGridHeightsAndGradients = world.getGridHeightsAndGradients
+        self.heightSamples = world.heightSamples
+        self.borderCache = world.borderCache
+        self.regionStore = world.regionStore
+
+    def initializeRegionStore(self, world=None):
+        """Opens region archives for a world, the current one by default."""
+
+        if world is None:
+            world = self.world
+        if not SAVED_REGION_ARCHIVES:
+            return
+        try:
+            numTextures = len(self.texturer.textureMapper.textures)
+        except AttributeError:
+            numTextures = 0
+        world.openRegionStore(TEXTURE_LAYER + numTextures)
+        if world is self.world:
+            self.regionStore = world.regionStore
 
-        #Remove old tiles that will not conform to a new heightmap
+    def regenerate(self, id=0):
+        """Replaces the world with a new one for seed id without a gap.
+
+        The tiles of the new world near the focus are built in the
+        background while the old tiles stay shown. Once all of them are
+        ready swapWorld() replaces the old tiles in a single frame.
+
+        """
+        self.cancelRegeneration()
+        world = self.createWorld(id)
+        self.initializeRegionStore(world)
+        self.pendingWorld = world
+
+        # the tiles within the middle level of detail of any focus
+        radius = self.minTileDistance * 0.2 + self.tileSize
+        offsets = ringOffsets(self.tileSize, radius)
+        halfTile = self.tileSize * 0.5
+        for focus in self.foci:
+            x, y = self.getFocusPosition(focus)
+            originX, originY = self.getFocusTile(x, y)
+            for dx, dy in offsets:
+                pos = (originX + dx, originY + dy)
+                deltaX = x - (pos[0] + halfTile)
+                deltaY = y - (pos[1] + halfTile)
+                if (deltaX * deltaX + deltaY * deltaY < radius * radius
+                        and not pos in self.pendingPositions):
+                    self.pendingPositions.append(pos)
+        logging.info("building " + str(len(self.pendingPositions)) + " tiles of world "
+                     + str(world.id))
+        for pos in self.pendingPositions:
+            if THREAD_LOAD_TERRAIN:
+                self.tileBuilder.build(pos, world)
+            else:
+                self.pendingQueue.append(pos)
+
+    def cancelRegeneration(self):
+        """Drops the world being built by regenerate(), if any."""
+
+        for tile in self.pendingTiles.values():
+            tile.destroy()
+        self.pendingTiles.clear()
+        self.pendingQueue.clear()
+        self.pendingPositions = []
+        if self.pendingWorld is not None:
+            if THREAD_LOAD_TERRAIN:
+                self.tileBuilder.clearQueue(self.pendingWorld)
+            # tiles of this world may still be in progress on other threads,
+            # so its archives are closed when it is collected
+            self.pendingWorld = None
+
+    def addPendingTile(self, pos, tile):
+        """Keeps a tile of the pending world until its swap."""
+
+        if not tile.committed:
+            tile.commit()
+        self.pendingTiles[pos] = tile
+        if len(self.pendingTiles) == len(self.pendingPositions):
+            self.swapWorld()
+
+    def buildPendingTile(self):
+        """Builds the next tile of the pending world on the main thread.
+
+        Returns True if a tile was built.
+
+        """
+        if not len(self.pendingQueue):
+            return False
+        pos = self.pendingQueue.popleft()
+        tile = self.createTile(pos, world=self.pendingWorld)
+        tile.octaveDetail = self.getOctaveDetail(pos)
+        tile.make()
+        self.addPendingTile(pos, tile)
+        return True
+
+    def swapWorld(self):
+        """Replaces every tile of the current world with the pending tiles."""
+
+        logging.info("swapping to world " + str(self.pendingWorld.id))
         for pos, tile in self.tiles.items():
             self.deleteTile(pos)
         self.storage.clear()
-
-        self.heightMap = HeightMap(id, self.waterHeight + 0.03)
-        self.getHeight = self.heightMap.getHeight
+        self.refineQueue.clear()
+        self.removalQueue.clear()
+        self.lodChanges.clear()
+        if THREAD_LOAD_TERRAIN:
+            self.tileBuilder.clearQueue()
+
+        # tiles of the old world may still be in progress, so its archives
+        # are closed when it is collected
+        self.setWorld(self.pendingWorld)
+        for pos, tile in self.pendingTiles.items():
+            self.attachTile(pos, tile)
+            if not pos in self.tileReferences:
+                # the foci moved away while the tile was being built
+                self.removalQueue.append(pos)
+        self.pendingWorld = None
+        self.pendingTiles = {}
+        self.pendingPositions = []
 
     def initializeRenderingProperties(self):
         logging.info("initializing terrain rendering properties...")
@@ -278,7 +429,6 @@ class Terrain(NodePath):
         ##Add tasks to keep updating the terrain
         #taskMgr.add(self.updateTilesTask, "updateTiles", sort=9, priority=0)
         taskMgr.doMethodLater(5, self.update, "update", sort=9, priority=0)
-        self.updateStep = 1
 
     def reduceSceneGraph(self, radius):
         gr = self.graphReducer
@@ -290,24 +440,161 @@ class Terrain(NodePath):
         gr.unify(self.node(), False)
 
     def update(self, task):
-        """This task updates terrain as needed."""
+        """This task updates terrain as needed.
 
-        if self.updateStep == 1:
-            self.makeNewTile()
-            if THREAD_LOAD_TERRAIN:
-                self.grabBuiltTile()
-
-            self.removeOldTiles()
-            self.updateStep += 1
-            return Task.cont
+        The tiles to remove and the detail changes are found first, if the
+        focus moved enough for them to change, see checkFocus(). The work
+        itself is done in units: removing, attaching, making or refining a
+        tile, or changing its detail. Units are taken from each kind of work
+        in turn until TERRAIN_FRAME_BUDGET milliseconds have passed, and the
+        rest is left for the next frames. At least one unit is done each
+        frame.
 
+        """
+        self.checkFocus()
         #self.updateTiles()
-        self.tileLodUpdate()
         #self.buildDetailLevels()
 
-        self.updateStep = 1
+        deadline = time.time() + TERRAIN_FRAME_BUDGET / 1000.0
+        maintenance = self.maintenance
+        idle = 0
+        while idle < len(maintenance):
+            work = maintenance[self.maintenanceIndex]
+            self.maintenanceIndex = (self.maintenanceIndex + 1) % len(maintenance)
+            done = work()
+            # grabBuiltTile() returns the tile it attached
+            if done is None or done is False:
+                idle += 1
+                continue
+            idle = 0
+            if time.time() >= deadline:
+                break
         return Task.cont
 
+    def checkFocus(self):
+        """Starts the maintenance made necessary by movement of the foci.
+
+        The tiles a focus keeps are counted again and missing tiles searched
+        for when it or its predicted position moves to another tile. Tile
+        details are checked when a focus has moved a quarter tile, which is
+        well within the gaps between the LOD bands of tileLodUpdate(), or
+        when tiles were attached. A focus standing still costs next to
+        nothing.
+
+        """
+        moved = False
+        checkLod = self.lodDirty
+        quarterTile = self.tileSize * 0.25
+        positions = []
+        for focus in self.foci:
+            x, y = self.getFocusPosition(focus)
+            positions.append((x, y))
+            predicted = self.getPredictedFocus(focus)
+            focusTiles = (self.getFocusTile(x, y),
+                          predicted and self.getFocusTile(predicted[0], predicted[1]))
+            if focusTiles != focus.tiles:
+                focus.tiles = focusTiles
+                moved = True
+                # prefetched tiles are kept while the focus is heading towards them
+                self.updateTileReferences(focus, [(x, y), predicted or (x, y)])
+            if checkLod or focus.lodPosition is None:
+                checkLod = True
+                continue
+            deltaX = x - focus.lodPosition[0]
+            deltaY = y - focus.lodPosition[1]
+            if deltaX * deltaX + deltaY * deltaY >= quarterTile * quarterTile:
+                checkLod = True
+
+        if moved:
+            self.tilesMissing = True
+            if THREAD_LOAD_TERRAIN:
+                self.tileBuilder.setFocus(positions)
+        if not checkLod:
+            return
+        for focus, position in zip(self.foci, positions):
+            focus.lodPosition = position
+        self.lodDirty = False
+        self.tileLodUpdate()
+
+    def addFocus(self, nodePath, maxRange=None):
+        """Keeps tiles loaded around another NodePath as well.
+
+        maxRange is how far the focus sees, the terrain's maxViewRange by
+        default. Tiles in range of several foci are made and kept only once,
+        and each tile gets the level of detail of the nearest focus. Returns
+        the new TerrainFocus.
+
+        """
+        if maxRange is None:
+            maxRange = self.maxViewRange
+        focus = TerrainFocus(self, nodePath, maxRange)
+        self.foci.append(focus)
+        self.tilesMissing = True
+        self.lodDirty = True
+        return focus
+
+    def removeFocus(self, nodePath):
+        """Stops keeping tiles loaded around a NodePath given to addFocus().
+
+        The main focus, see setFocus(), can not be removed.
+
+        """
+        for focus in self.foci[1:]:
+            if focus.nodePath == nodePath:
+                self.foci.remove(focus)
+                self.releaseTiles(focus.references)
+                self.lodDirty = True
+                if THREAD_LOAD_TERRAIN:
+                    self.tileBuilder.setFocus([self.getFocusPosition(other)
+                                               for other in self.foci])
+                return
+
+    def getFocusPosition(self, focus):
+        """Returns the position of a TerrainFocus in tile units."""
+
+        # tiles are placed under the terrain node path which may be scaled
+        return (focus.nodePath.getX(self) / self.horizontalScale,
+                focus.nodePath.getY(self) / self.horizontalScale)
+
+    def updateTileReferences(self, focus, points):
+        """Counts the tiles focus keeps around points again.
+
+        A focus keeps every tile in range of its tiles, so moving within a
+        tile changes nothing. Tiles no focus keeps anymore are released, see
+        releaseTiles().
+
+        """
+        references = set()
+        for x, y in points:
+            originX, originY = self.getFocusTile(x, y)
+            references.update((originX + dx, originY + dy) for dx, dy in focus.keepOffsets)
+        tileReferences = self.tileReferences
+        for pos in references - focus.references:
+            tileReferences[pos] = tileReferences.get(pos, 0) + 1
+        self.releaseTiles(focus.references - references)
+        focus.references = references
+
+    def releaseTiles(self, positions):
+        """Drops a reference to each tile position.
+
+        Tiles left without references are cancelled at once if they are still
+        being built. The others are removed by removeOldTile() within the
+        frame budget, unless a focus takes them back first.
+
+        """
+        tileReferences = self.tileReferences
+        for pos in positions:
+            count = tileReferences[pos] - 1
+            if count > 0:
+                tileReferences[pos] = count
+                continue
+            del tileReferences[pos]
+            tile = self.tiles.get(pos)
+            if tile == 1:
+                self.storeTile(pos)
+            elif tile is not None:
+                self.removalQueue.append(pos)
+
     def updateLight(self):
         """This task moves point and directional lights.
 
@@ -343,8 +630,7 @@ class Terrain(NodePath):
             self.updateTiles()
             return
 
-        focusx = self.focus.getX() / self.horizontalScale
-        focusy = self.focus.getY() / self.horizontalScale
+        points = self.getLodPoints()
         halfTile = self.tileSize * 0.5
 
         # switch to high, mid, and low LOD's at these distances
@@ -363,20 +649,97 @@ class Terrain(NodePath):
         horizonInner = self.minTileDistance * 0.5 + self.tileSize + halfTile
         horizonInner *= horizonInner
 
+        # details are changed by changeTileDetail() within the frame budget
         for pos, tile in self.tiles.items():
-            deltaX = focusx - (pos[0] + halfTile)
-            deltaY = focusy - (pos[1] + halfTile)
-            distance = deltaX * deltaX + deltaY * deltaY
+            if tile == 1:
+                continue
+            distance = self.getNearestDistanceSq(pos, points)
+            detail = None
             if distance < highOuter:
-                tile.setDetail(0)
+                detail = 0
             elif distance < midOuter:
                 if distance > midInner or tile.getDetail() > 1:
-                    tile.setDetail(1)
+                    detail = 1
             elif distance < lowOuter:
                 if distance > lowInner or tile.getDetail() > 2:
-                    tile.setDetail(2)
+                    detail = 2
             elif distance > horizonInner:
-                tile.setDetail(3)
+                detail = 3
+            if detail is None or detail == tile.getDetail():
+                self.lodChanges.pop(pos, None)
+            else:
+                self.lodChanges[pos] = detail
+            if tile.needsRefinement():
+                self.requestRefinement(tile)
+
+    def changeTileDetail(self):
+        """Gives the oldest tile waiting for it its new level of detail.
+
+        Returns True if a tile was changed.
+
+        """
+        while len(self.lodChanges):
+            pos, detail = self.lodChanges.popitem(last=False)
+            tile = self.tiles.get(pos)
+            if tile is None or tile == 1:
+                continue
+            tile.setDetail(detail)
+            if tile.needsRefinement():
+                self.requestRefinement(tile)
+            return True
+        return False
+
+    def getLodDetail(self, pos):
+        """Returns the detail tileLodUpdate() would give a new tile at pos."""
+
+        distance = math.sqrt(self.getNearestDistanceSq(pos, self.getLodPoints()))
+        # the outer radius of the high, mid and low LOD's
+        for detail, ratio in enumerate((0.02, 0.2, 0.5)):
+            if distance < self.minTileDistance * ratio + self.tileSize:
+                return detail
+        return 3
+
+    def getLodPoints(self):
+        """Returns the positions of the foci levels of detail are measured from."""
+
+        return [self.getFocusPosition(focus) for focus in self.foci]
+
+    def getNearestDistanceSq(self, pos, points):
+        """Returns the squared distance from the center of the tile at pos to
+        the nearest of points."""
+
+        halfTile = self.tileSize * 0.5
+        nearest = None
+        for x, y in points:
+            deltaX = x - (pos[0] + halfTile)
+            deltaY = y - (pos[1] + halfTile)
+            distance = deltaX * deltaX + deltaY * deltaY
+            if nearest is None or distance < nearest:
+                nearest = distance
+        return nearest
+
+    def getOctaveDetail(self, pos):
+        """Returns the detail whose octaves a new tile at pos is generated with.
+
+        Far tiles are shown with widely spaced vertices, so octaves finer than
+        that spacing are skipped until the tile comes closer.
+
+        """
+        if not PRUNE_FAR_OCTAVES or not self.bruteForce:
+            return 0
+        return self.getLodDetail(pos)
+
+    def requestRefinement(self, tile):
+        """Queues a tile to be rebuilt with every octave, once."""
+
+        if tile.refining:
+            return
+        tile.refining = True
+        pos = (tile.xOffset, tile.yOffset)
+        if THREAD_LOAD_TERRAIN:
+            self.tileBuilder.refine(pos)
+        else:
+            self.refineQueue.append(pos)
 
     def buildDetailLevels(self):
         """Unused."""
@@ -426,6 +789,9 @@ class Terrain(NodePath):
                     if distanceSquared < buildDistanceSquared:
                         self.buildQueue.append((x, y))
 
+        if self.regionStore:
+            self.regionStore.preload(self.buildQueue)
+
         total = len(self.buildQueue)
         while len(self.buildQueue):
             if self.feedBackString:
@@ -458,6 +824,7 @@ class Terrain(NodePath):
         # load distance and the unloading distance
         buildDistanceSquared = (self.minTileDistance + self.maxTileDistance) / 2
         buildDistanceSquared = buildDistanceSquared * buildDistanceSquared
+        positions = []
 
         for x in range (xstart - checkRadius, xstart + checkRadius, self.tileSize):
             for y in range (ystart - checkRadius, ystart + checkRadius, self.tileSize):
@@ -467,7 +834,14 @@ class Terrain(NodePath):
                     distanceSquared = deltaX * deltaX + deltaY * deltaY
 
                     if distanceSquared < buildDistanceSquared:
-                        self.tileBuilder.preload((x, y))
+                        positions.append((x, y))
+
+        if self.regionStore:
+            self.regionStore.preload(positions)
+        for pos in positions:
+            # dispatched like any other tile, so the builder's results are
+            # attached by grabBuiltTile() instead of being stored
+            self.dispatchTile(pos)
         self.preloadTotal = self.tileBuilder.queue.qsize()
         taskMgr.add(self.preloadWait, "preloadWaitTask")
 
@@ -489,128 +863,315 @@ class Terrain(NodePath):
 
     #@pstat
     def makeNewTile(self):
-        """Generate the closest terrain tile needed."""
+        """Generate the closest terrain tile needed.
 
-        # tiles are placed under the terrain node path which may be scaled
-        x = self.focus.getX(self) / self.horizontalScale
-        y = self.focus.getY(self) / self.horizontalScale
-        # start position is the focus position rounded to the multiple of tile size
-        xstart = (int(x) / self.tileSize) * self.tileSize
-        ystart = (int(y) / self.tileSize) * self.tileSize
-        # radius is rounded up from minTileDistance to nearest multiple of tile size
-        # not every tile within checkRadius will be made
-        checkRadius = (int(self.minTileDistance) / self.tileSize + 1) * self.tileSize
+        The closest missing tile of any focus is made first. Once every tile
+        in range of the foci is made, tiles in range of their predicted
+        positions are prefetched, see getPredictedFocus(). Returns True if a
+        tile was made.
+
+        """
+        # nothing is missing until a focus moves or tiles are removed
+        if not self.tilesMissing:
+            return False
+        pos = self.findClosestMissingTile(True)
+        if pos is None:
+            pos = self.findClosestMissingTile(False)
+        if pos is None:
+            self.tilesMissing = False
+            return False
+        if THREAD_LOAD_TERRAIN:
+            self.dispatchTile(pos)
+        else:
+            self._generateTile(pos, COARSE_TILE_SIZE > 0)
+        return True
+
+    def findClosestMissingTile(self, focused=True):
+        """Returns the position of the missing tile closest to a focus, or
+        None.
+
+        Tiles around the foci are searched if focused is set, or else tiles
+        around their predicted positions.
+
+        """
+        closest = None
+        closestDistance = None
+        for focus in self.foci:
+            if focused:
+                x, y = self.getFocusPosition(focus)
+            else:
+                predicted = self.getPredictedFocus(focus)
+                if predicted is None:
+                    continue
+                x, y = predicted
+            pos = self.findMissingTile(x, y, focus, focused)
+            if pos is None:
+                continue
+            distance = self.getNearestDistanceSq(pos, [(x, y)])
+            if closestDistance is None or distance < closestDistance:
+                closest = pos
+                closestDistance = distance
+        return closest
+
+    def findMissingTile(self, x, y, focus, focused=True):
+        """Returns the position of the closest tile in range of x, y that is
+        not made, or None.
+
+        The range is that of a TerrainFocus. focused must be set for the
+        position of the focus, whose search order is kept between calls.
+
+        """
         halfTile = self.tileSize * 0.49
         tiles = self.tiles
+        minDistanceSq = focus.minTileDistance * focus.minTileDistance
+
+        if focused:
+            # walk out from the focus tile, skipping the tiles known to be loaded
+            order = self.getTileSearchOrder(focus, x, y)
+            start = focus.searchStart
+            while start < len(order) and order[start] in tiles:
+                start += 1
+            focus.searchStart = start
+            positions = (order[i] for i in range(start, len(order)))
+        else:
+            originX, originY = self.getFocusTile(x, y)
+            positions = ((originX + dx, originY + dy) for dx, dy in focus.searchOffsets)
+
+        for pos in positions:
+            if pos in tiles:
+                continue
+            deltaX = x - (pos[0] + halfTile)
+            deltaY = y - (pos[1] + halfTile)
+            if deltaX * deltaX + deltaY * deltaY < minDistanceSq:
+                return pos
+        return None
 
-        #logging.info( xstart, ystart, checkRadius)
-        vec = 0
-        minFoundDistance = 9999999999.0
-        minDistanceSq = self.minTileDistance * self.minTileDistance
-
-        for checkX in range (xstart - checkRadius, xstart + checkRadius, self.tileSize):
-            for checkY in range (ystart - checkRadius, ystart + checkRadius, self.tileSize):
-                if not (checkX, checkY) in tiles:
-                    deltaX = x - (checkX + halfTile)
-                    deltaY = y - (checkY + halfTile)
-                    distanceSq = deltaX * deltaX + deltaY * deltaY
-
-                    if distanceSq < minDistanceSq and distanceSq < minFoundDistance:
-                        minFoundDistance = distanceSq
-                        vec = (checkX, checkY)
-        if not vec == 0:
-            #logging.info( distance," < ",self.minTileDistance," and ",distance," < ",minDistance)
-            #self.generateTile(vec.getX(), vec.getY())
-            if THREAD_LOAD_TERRAIN:
-                self.dispatchTile(vec)
-            else:
-                self._generateTile(vec)
+    def getPredictedFocus(self, focus=None):
+        """Returns where a focus will be TILE_PREFETCH_TIME seconds from now.
 
+        focus is a TerrainFocus, the main focus by default. Its NodePath must
+        have a velocity and optionally a turbo multiplier like a Walker. None
+        is returned if prefetching is disabled or the focus will not leave
+        its tile. The prediction is never further than minTileDistance ahead,
+        so prefetched tiles stay next to those around the focus.
 
+        """
+        if focus is None:
+            focus = self.foci[0]
+        nodePath = focus.nodePath
+        velocity = getattr(nodePath, "velocity", None)
+        if not TILE_PREFETCH_TIME or velocity is None:
+            return None
+        lookAhead = TILE_PREFETCH_TIME * getattr(nodePath, "turbo", 1)
+        lookAhead /= self.horizontalScale
+        deltaX = velocity.getX() * lookAhead
+        deltaY = velocity.getY() * lookAhead
+        distance = math.sqrt(deltaX * deltaX + deltaY * deltaY)
+        if distance < self.tileSize:
+            return None
+        if distance > focus.minTileDistance:
+            deltaX *= focus.minTileDistance / distance
+            deltaY *= focus.minTileDistance / distance
+        x, y = self.getFocusPosition(focus)
+        return (x + deltaX, y + deltaY)
+
+    def getFocusTile(self, x, y):
+        """Returns the position of the tile under x, y."""
+
+        tileSize = self.tileSize
+        return (int(math.floor(x / tileSize)) * tileSize,
+                int(math.floor(y / tileSize)) * tileSize)
+
+    def getTileSearchOrder(self, focus, x, y):
+        """Returns the positions of the tiles around x, y, closest first.
+
+        The positions are kept by the TerrainFocus and only recomputed when
+        x, y moves to another tile.
+
+        """
+        origin = self.getFocusTile(x, y)
+        if origin != focus.searchOrigin:
+            focus.searchOrigin = origin
+            focus.searchOrder = [(origin[0] + dx, origin[1] + dy)
+                                 for dx, dy in focus.searchOffsets]
+            focus.searchStart = 0
+        return focus.searchOrder
 
     #@pstat
     def dispatchTile(self, pos):
         """Creates a terrain tile at the input coordinates."""
 
-        if pos in self.storage:
-            tile = self.storage[pos]
-            self.tiles[pos] = tile
-            tile.getRoot().reparentTo(self)
-            del self.storage[pos]
+        tile = self.storage.pop(pos)
+        if tile is not None:
+            self.attachTile(pos, tile)
             logging.info("tile recovered from storage at " + str(pos))
             return
 
         self.tileBuilder.build(pos)
         self.tiles[pos] = 1
 
+    def attachTile(self, pos, tile):
+        """Shows a tile, committing it first if it was only prepared."""
+
+        if not tile.committed:
+            tile.commit()
+        tile.getRoot().reparentTo(self)
+        self.tiles[pos] = tile
+        # the new tile needs a level of detail
+        self.lodDirty = True
+
     #@pstat
-    def _generateTile(self, pos):
-        """Creates a terrain tile at the input coordinates."""
+    def _generateTile(self, pos, coarse=False, octaveDetail=None):
+        """Creates a terrain tile at the input coordinates.
+
+        A coarse tile is quick to make and is queued to be replaced by a full
+        tile in refineTile(). octaveDetail defaults to getOctaveDetail().
 
-        if pos in self.storage:
-            tile = self.storage[pos]
-            self.tiles[pos] = tile
-            tile.getRoot().reparentTo(self)
-            del self.storage[pos]
+        """
+
+        tile = self.storage.pop(pos)
+        if tile is not None:
+            self.attachTile(pos, tile)
             logging.info("tile recovered from storage at " + str(pos))
             #self.flattenMedium()
             return
 
-        if SAVED_TEXTURE_MAPS:
-            tile = TextureMappedTerrainTile(self, pos[0], pos[1])
-        elif self.bruteForce:
-            tile = LodTerrainTile(self, pos[0], pos[1])
-        else:
-            tile = TerrainTile(self, pos[0], pos[1])
+        tile = self.createTile(pos, coarse)
+        if coarse:
+            tile.refining = True
+            self.refineQueue.append(pos)
+        if octaveDetail is None:
+            octaveDetail = self.getOctaveDetail(pos)
+        if not coarse:
+            tile.octaveDetail = octaveDetail
         tile.make()
-        tile.getRoot().reparentTo(self)
-        self.tiles[pos] = tile
+        self.attachTile(pos, tile)
         logging.info("tile generated at " + str(pos))
         #self.flattenMedium()
 
         return tile
 
+    def createTile(self, pos, coarse=False, world=None):
+        """Returns a new, unmade tile of the kind this terrain uses."""
+
+        if coarse:
+            return CoarseTerrainTile(self, pos[0], pos[1], COARSE_TILE_SIZE, world)
+        if SAVED_TEXTURE_MAPS:
+            return TextureMappedTerrainTile(self, pos[0], pos[1], world=world)
+        if self.bruteForce:
+            return LodTerrainTile(self, pos[0], pos[1], world=world)
+        return TerrainTile(self, pos[0], pos[1], world=world)
+
+    def refineTile(self):
+        """Replaces the oldest coarse or pruned tile still in use.
+
+        Coarse tiles are replaced by full tiles, pruned tiles that came
+        closer by tiles with every octave. Returns True if a tile was
+        replaced.
+
+        """
+        while len(self.refineQueue):
+            pos = self.refineQueue.popleft()
+            tile = self.tiles.get(pos)
+            if tile is None or tile == 1:
+                continue
+            tile.refining = False
+            if not tile.needsRefinement():
+                continue
+            tile.destroy()
+            del self.tiles[pos]
+            if isinstance(tile, CoarseTerrainTile):
+                self._generateTile(pos)
+            else:
+                self._generateTile(pos, octaveDetail=0)
+            return True
+        return False
+
     def grabBuiltTile(self):
+        """Attaches a tile finished by the tileBuilder, if there is one.
+
+        Returns the tile, which may be None.
+
+        """
+        if not THREAD_LOAD_TERRAIN or self.tileBuilder.out_queue.empty():
+            return None
         #logging.info( "grabBuiltTile()")
         tile = self.tileBuilder.grab()
         #logging.info( "tlie = "+ str(tile))
-        if tile:
+        if tile is not None:
             pos = (tile.xOffset, tile.yOffset)
-            tile.getRoot().reparentTo(self)
-            self.tiles[pos] = tile
+            if tile.world is not self.world:
+                if tile.world is self.pendingWorld:
+                    self.addPendingTile(pos, tile)
+                else:
+                    # the tile belongs to a world that was replaced
+                    tile.destroy()
+                return None
+            if not pos in self.tiles:
+                # the tile was removed while it was being built
+                if isinstance(tile, CoarseTerrainTile):
+                    tile.destroy()
+                else:
+                    self.storage.put(pos, tile, tile.getMemorySize())
+                return None
+            # a full tile replaces the coarse tile shown in the meantime
+            old = self.tiles.get(pos)
+            if old and old != 1:
+                old.destroy()
+            self.attachTile(pos, tile)
             logging.info("tile generated at " + str(pos))
             return tile
         return None
 
-    #@pstat
-    def removeOldTiles(self):
-        """Remove distant tiles to free system resources."""
+    def removeOldTile(self):
+        """Stores the next tile released by releaseTiles().
 
-        x = self.focus.getX(self) / self.horizontalScale
-        y = self.focus.getY(self) / self.horizontalScale
-        center = self.tileSize * 0.5
-        maxDistanceSquared = self.maxTileDistance * self.maxTileDistance
-        for pos, tile in self.tiles.items():
-            deltaX = x - (pos[0] + center)
-            deltaY = y - (pos[1] + center)
-            distance = deltaX * deltaX + deltaY * deltaY
-            if distance > maxDistanceSquared:
-                #logging.info( distance+ " > "+ self.maxTileDistance * self.maxTileDistance)
+        Tiles a focus took back in the meantime are skipped. Returns True if
+        a tile was stored.
+
+        """
+        while len(self.removalQueue):
+            pos = self.removalQueue.popleft()
+            if pos in self.tiles and not pos in self.tileReferences:
                 self.storeTile(pos)
+                return True
+        return False
 
     def storeTile(self, pos):
         tile = self.tiles[pos]
-        if tile != 1:
+        if tile == 1:
+            # the tile is not needed anymore if it has not been started
+            self.tileBuilder.cancel(pos)
+        elif isinstance(tile, CoarseTerrainTile):
+            # coarse tiles are cheap to remake and not worth storing
+            tile.destroy()
+        else:
             tile.getRoot().detachNode()
-            self.storage[pos] = tile
+            self.storage.put(pos, tile, tile.getMemorySize())
         del self.tiles[pos]
+        for focus in self.foci:
+            focus.searchStart = 0
+        self.tilesMissing = True
         logging.info("Tile removed from " + str(pos))
 
+    def evictTile(self, pos, tile):
+        """Frees a tile pushed out of storage by the memory budget."""
+
+        tile.destroy()
+        logging.info("Tile evicted from storage at " + str(pos))
+
     def deleteTile(self, pos):
         """Removes a specific tile from the Terrain."""
 
-        self.tiles[pos].getRoot().detachNode()
+        tile = self.tiles[pos]
+        if tile == 1:
+            self.tileBuilder.cancel(pos)
+        else:
+            tile.destroy()
         del self.tiles[pos]
+        for focus in self.foci:
+            focus.searchStart = 0
+        self.tilesMissing = True
         logging.info("Tile deleted from " + str(pos))
 
     def getElevation(self, x, y):
@@ -618,16 +1179,64 @@ class Terrain(NodePath):
 
         x /= self.horizontalScale
         y /= self.horizontalScale
-        if SAVED_HEIGHT_MAPS:
-            tilex = (int(x) / self.tileSize) * self.tileSize
-            tiley = (int(y) / self.tileSize) * self.tileSize
-            x -= tilex
-            y -= tiley
-            if (tilex, tiley) in self.tiles:
-                return self.tiles[tilex, tiley].getElevation(x, y) * self.getSz()
-            if (tilex, tiley) in self.storage:
-                return self.storage[tilex, tiley].getElevation(x, y) * self.getSz()
-        return self.getHeight(x, y) * self.getSz()
+        return self.getTileHeight(x, y) * self.maxHeight
+
+    def getTileHeight(self, x, y):
+        """Returns the height in [0,1] at x, y in heightmap coordinates.
+
+        The height is interpolated from the samples of the tile covering x, y
+        if it is loaded or stored, so it matches the rendered surface.
+        Elsewhere it comes from memoized heightmap samples.
+
+        """
+        tileSize = self.tileSize
+        tileX = int(math.floor(x / tileSize)) * tileSize
+        tileY = int(math.floor(y / tileSize)) * tileSize
+        tile = self.getResidentTile((tileX, tileY))
+        if tile is not None:
+            return tile.getLocalHeight(x - tileX, y - tileY)
+        return self.heightSamples.getHeight(x, y)
+
+    def getElevations(self, xs, ys):
+        """Returns the heights of the terrain at arrays of world coordinates.
+
+        This is the batch version of getElevation(). Points are grouped by
+        tile and each group is interpolated from its tile's heights at once.
+
+        """
+        xs = numpy.asarray(xs, numpy.float64) / self.horizontalScale
+        ys = numpy.asarray(ys, numpy.float64) / self.horizontalScale
+        return self.getTileHeights(xs, ys) * self.maxHeight
+
+    def getTileHeights(self, xs, ys):
+        """Returns the heights in [0,1] at arrays of heightmap coordinates."""
+
+        shape = numpy.shape(xs)
+        xs = numpy.ravel(xs)
+        ys = numpy.ravel(ys)
+        tileSize = self.tileSize
+        tileXs = numpy.floor(xs / tileSize).astype(numpy.int64) * tileSize
+        tileYs = numpy.floor(ys / tileSize).astype(numpy.int64) * tileSize
+        heights = numpy.empty(xs.shape)
+        for tileX, tileY, points in groupByCell(tileXs, tileYs):
+            tile = self.getResidentTile((tileX, tileY))
+            if tile is not None:
+                heights[points] = tile.getLocalHeights(xs[points] - tileX,
+                                                       ys[points] - tileY)
+            else:
+                heights[points] = self.heightSamples.getHeights(xs[points], ys[points])
+        return heights.reshape(shape)
+
+    def getResidentTile(self, pos):
+        """Returns the loaded or stored tile at pos if its heights are known."""
+
+        tile = self.tiles.get(pos)
+        if tile is None:
+            tile = self.storage.get(pos)
+        # tiles under construction are only a placeholder
+        if getattr(tile, "heights", None) is None:
+            return None
+        return tile
 
     def setWireFrame(self, state):
         self.wireFrame = state
@@ -649,6 +1258,11 @@ class Terrain(NodePath):
         self.setShaderInput(name, PTAFloat([input]))
 
     def setFocus(self, nodePath):
+        """Makes nodePath the main focus, keeping the range of the old one."""
+
         self.focus = nodePath
+        self.foci[0].nodePath = nodePath
+        self.foci[0].tiles = None
+        self.lodDirty = True
         for pos, tile in self.tiles.items():
             tile.setFocalPoint(self.focus)
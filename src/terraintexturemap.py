@@ -10,6 +10,7 @@ __author__ = "Stephen Lujan"
 from pandac.PandaModules import PNMImage
 from pandac.PandaModules import Vec4
 from config import *
+from tilegenerator import calculateTextureWeights
 
 class TerrainShaderTexture:
 
@@ -106,3 +107,14 @@ class TextureMapper:
                     #logging.info( tex.image.getGray(x,y))
                     #tex.image.setAlpha(x, y, 0.3)
                     #tex.image.setAlpha(5, 5, 0.25)
+
+    def calculateTextureWeights(self, heights, slopes):
+        """Returns an array of weights for each texture.
+
+        This is the array version of calculateTextures(). heights and slopes
+        are arrays of the same shape and so is each returned weight array.
+
+        """
+        textureRegions = [tex.regions for tex in self.textures]
+        return calculateTextureWeights(heights, slopes, textureRegions,
+                                       self.terrain.maxHeight)
@@ -18,6 +18,7 @@ from pandac.PandaModules import Vec4
 from fullterrainshadergenerator import *
 from bakedterrainshadergenerator import *
 from terraintexturemap import *
+from tilegenerator import defaultTextureRegions
 
 ###############################################################################
 #   TerrainTexturer
@@ -188,20 +189,14 @@ class ShaderTexturer(TerrainTexturer):
         # regionLimits ( min height, max height, min slope, max slope )
 
         self.textureMapper = TextureMapper(self.terrain)
-
-        self.textureMapper.addTexture(self.tex1)
-        self.textureMapper.addRegionToTex(Vec4(-9999.0, self.indexToHeight(0.1), -0.001, 1.001))
-
-        self.textureMapper.addTexture(self.tex2)
-        self.textureMapper.addRegionToTex(Vec4(self.indexToHeight(-0.15), self.indexToHeight(0.75), -0.001, 0.30))
-
-        self.textureMapper.addTexture(self.tex3)
-        self.textureMapper.addRegionToTex(Vec4(self.indexToHeight(0.1), self.indexToHeight(0.95), 0.10, 1.001))
-        #second region forces tex 2 and 4 to blend a bit at their boundries regardless of slope
-        self.textureMapper.addRegionToTex(Vec4(self.indexToHeight(0.4), self.indexToHeight(0.9), -0.001, 1.001))
-
-        self.textureMapper.addTexture(self.tex4)
-        self.textureMapper.addRegionToTex(Vec4(self.indexToHeight(0.72), 9999.0, -0.001, 1.001))
+        # the regions are shared with headless generation, see TerrainWorld
+        textureRegions = defaultTextureRegions(self.terrain.waterHeight,
+                                               self.terrain.maxHeight)
+        textures = (self.tex1, self.tex2, self.tex3, self.tex4)
+        for tex, regions in zip(textures, textureRegions):
+            self.textureMapper.addTexture(tex)
+            for limits in regions:
+                self.textureMapper.addRegionToTex(Vec4(*limits))
 
         logging.info( "intializing terrain shader generator...")
         file = 'shaders/terrain.sha'
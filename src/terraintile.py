@@ -8,14 +8,16 @@ __date__ = "$Oct 27, 2010 4:47:05 AM$"
 
 from collections import deque
 from config import *
+import numpy
 from pandac.PandaModules import Filename
 from pandac.PandaModules import GeoMipTerrain
 from pandac.PandaModules import NodePath
 from pandac.PandaModules import PNMImage
+from pandac.PandaModules import StringStream
 from pandac.PandaModules import Texture
 from pandac.PandaModules import TextureStage
 from pandac.PandaModules import BitMask32
-from pandac.PandaModules import Vec3
+from pandac.PandaModules import SceneGraphAnalyzer
 from pstat_debug import pstat
 from pandac.PandaModules import AsyncTask
 from pandac.PandaModules import AsyncTaskManager
@@ -23,9 +25,39 @@ from direct.task.Task import Task
 #from direct.stdpy import threading2 as threading
 import threading
 import Queue
+import heapq
 import time
+from tilecache import readHeightFile
+from tilecache import writeHeightFile
+from tilegenerator import generateHeights
+from tilegenerator import generateHeightsAndSlopes
+from tileregion import HEIGHT_LAYER
+from tileregion import SLOPE_LAYER
+from tileregion import TEXTURE_LAYER
+from tilegenerator import interpolateHeight
+from tilegenerator import interpolateHeights
+from tilegenerator import octaveSpacing
 
 
+###############################################################################
+#   arrayToImage
+###############################################################################
+
+def arrayToImage(array, maxval=65535):
+    """Returns a grayscale PNMImage made from a 2d array of values in [0,1].
+
+    Row 0 of the array becomes the top row of the image. The array is encoded
+    as a binary pgm in one pass and decoded by panda in c++, which is far
+    faster than calling setGray() once per pixel.
+
+    """
+    values = numpy.clip(numpy.asarray(array) * maxval + 0.5, 0, maxval)
+    values = values.astype('>u2')
+    ySize, xSize = values.shape
+    header = "P5\n%d %d\n%d\n" % (xSize, ySize, maxval)
+    image = PNMImage()
+    image.read(StringStream(header + values.tostring()), "heightmap.pgm")
+    return image
 
 ###############################################################################
 #   TerrainTile
@@ -34,21 +66,38 @@ import time
 class TerrainTile(GeoMipTerrain):
     """TerrainTiles are the building blocks of a terrain."""
 
-    def __init__(self, terrain, x, y):
+    def __init__(self, terrain, x, y, world=None):
         """Builds a Tile for the terrain at input coordinates.
 
         Important settings are used directly from the terrain.
         This allows for easier setting changes, and reduces memory overhead.
         x and y parameters give the appropriate world coordinates of this tile.
+        Heights come from world, the terrain's current TerrainWorld by default.
 
         """
 
         self.terrain = terrain
+        if world is None:
+            world = terrain.world
+        self.world = world
         self.xOffset = x
         self.yOffset = y
         self.heightMapDetail = 1 # higher means greater detail
-
-        self.name = "ID" + str(terrain.id) + "_X" + str(x) + "_Y" + str(y)
+        # height and slope arrays indexed [y, x], may be supplied in advance
+        self.heights = None
+        self.slopes = None
+        # generate slopes along with the heights for a slope map
+        self.needsSlopes = False
+        # the level of detail the heights were generated for, octaves too
+        # fine to show at that level are left out, 0 means every octave
+        self.octaveDetail = 0
+        self.refining = False
+        # set while the tile holds its edges in the world's TileBorderCache
+        self.holdsBorders = False
+        # set once commit() has built the GeoMip
+        self.committed = False
+
+        self.name = "ID" + str(world.id) + "_X" + str(x) + "_Y" + str(y)
         GeoMipTerrain.__init__(self, name=self.name)
 
         self.image = PNMImage()
@@ -102,39 +151,99 @@ class TerrainTile(GeoMipTerrain):
 
         Panda3d GeoMipMaps require an image from which to build and update
         their height field. This function creates the correct image using the
-        tile's position and the Terrain's getHeight() function.
+        tile's position and the Terrain's batch getHeights() function.
 
         """
 
+        fileName = "maps/height/" + self.name + ".height"
+        parameters = self.world.getTileParameters()
+        tileSize = self.terrain.tileSize
+        d = self.heightMapDetail
+        pos = (self.xOffset, self.yOffset)
+        store = self.world.regionStore
         if SAVED_HEIGHT_MAPS:
-            fileName = "maps/height/" + self.name + ".png"
             self.getRoot().setTag('EditableTerrain', '1')
-            if self.image.read(Filename(fileName)):
+
+        # heights may be supplied in advance, cached in memory or saved
+        # complete heights are always preferred over pruned ones
+        loaded = False
+        if self.heights is None:
+            self.heights = self.world.getCachedHeights(self.xOffset, self.yOffset, d)
+            if self.heights is not None:
+                self.octaveDetail = 0
+            elif self.octaveDetail:
+                self.heights = self.world.getCachedHeights(self.xOffset, self.yOffset,
+                                                             d, self.octaveDetail)
+            loaded = self.heights is not None
+            if loaded and self.slopes is None:
+                # slopes are cached along with the heights they belong to
+                self.slopes = self.world.getCachedSlopes(self.xOffset, self.yOffset,
+                                                         d, self.octaveDetail)
+        saved = False
+        if self.heights is None and store:
+            self.heights = store.read(pos, HEIGHT_LAYER)
+            saved = self.heights is not None
+        elif self.heights is None and SAVED_HEIGHT_MAPS:
+            self.heights = readHeightFile(fileName, parameters, tileSize, d)
+            saved = self.heights is not None
+            if saved:
                 logging.info( "read heightmap from " + fileName)
-                return
+        if saved:
+            # saved heights always include every octave
+            self.octaveDetail = 0
+            loaded = True
+
+        spacing = octaveSpacing(self.octaveDetail)
+        if self.heights is None and self.needsSlopes:
+            self.heights, self.slopes = generateHeightsAndSlopes(
+                self.world.getGridHeightsAndGradients, self.xOffset, self.yOffset,
+                tileSize, self.terrain.getSz(), d, spacing, self.terrain.erosion)
+        elif self.heights is None:
+            # rows of heights follow y and columns follow x
+            self.heights = generateHeights(self.world.getGridHeights, self.xOffset,
+                                           self.yOffset, tileSize, d, spacing,
+                                           self.terrain.erosion)
+        if d == 1 and not self.octaveDetail:
+            # the edges stay shared until the tile is destroyed
+            self.heights = self.world.shareTileBorders(self.xOffset, self.yOffset,
+                                                         self.heights,
+                                                         not self.holdsBorders)
+            self.holdsBorders = True
+            if self.slopes is not None:
+                self.slopes = self.world.shareTileSlopes(self.xOffset, self.yOffset,
+                                                         self.slopes)
+        elif d == 1:
+            # pruned tiles meet their neighbors' complete edges
+            self.heights = self.world.stitchTileBorders(self.xOffset, self.yOffset,
+                                                        self.heights)
+        # pruned heights are only kept in memory
+        save = not loaded and not self.octaveDetail
+        if store and save:
+            store.write(pos, HEIGHT_LAYER, self.heights)
+        elif SAVED_HEIGHT_MAPS and save:
+            logging.info( "saving heightmap to " + fileName)
+            writeHeightFile(fileName, self.heights, parameters, tileSize, d)
+        self.world.cacheHeights(self.xOffset, self.yOffset, d, self.heights,
+                                  self.octaveDetail)
+        if self.slopes is not None:
+            self.world.cacheSlopes(self.xOffset, self.yOffset, d, self.slopes,
+                                   self.octaveDetail)
+        # why is it necessary to invert the y axis I wonder?
+        self.image = arrayToImage(self.heights[::-1])
+        #self.postProcessImage()
 
-        heightMapSize = self.terrain.tileSize * self.heightMapDetail + 1
-        self.image = PNMImage(heightMapSize, heightMapSize, 1, 65535)
 
-        ySize = self.image.getYSize() - 1
-        getHeight = self.terrain.getHeight
-        setGray = self.image.setGray
-        xo = self.xOffset
-        yo = self.yOffset
+    def getLocalHeight(self, x, y):
+        """Returns the height in [0,1] at x, y relative to the tile origin."""
+
         d = self.heightMapDetail
+        return interpolateHeight(self.heights, x * d, y * d)
 
-        for x in range(self.image.getXSize()):
-            for y in range(ySize + 1):
-                height = getHeight(x / d + xo, y / d + yo)
-                #  feed pixel into image
-                # why is it necessary to invert the y axis I wonder?
-                setGray(x, ySize - y, height)
-        #self.postProcessImage()
-        if SAVED_HEIGHT_MAPS:
-            fileName = "maps/height/" + self.name + ".png"
-            logging.info( "saving heightmap to " + fileName)
-            self.image.write(Filename(fileName))
+    def getLocalHeights(self, xs, ys):
+        """Returns the heights at arrays of coordinates relative to the tile."""
 
+        d = self.heightMapDetail
+        return interpolateHeights(self.heights, xs * d, ys * d)
 
     def postProcessImage(self):
         """Perform filters and manipulations on the heightmap image."""
@@ -144,40 +253,90 @@ class TerrainTile(GeoMipTerrain):
     def setWireFrame(self, state):
         self.getRoot().setRenderModeWireframe()
 
+    def deriveSlopes(self):
+        """Returns the slopes of the heights, matching neighboring tiles."""
+
+        return self.world.getTileSlopes(self.xOffset, self.yOffset, self.heights,
+                                        self.heightMapDetail, self.octaveDetail)
+
     def makeSlopeMap(self):
+        """Makes the slope map image from slope arrays.
+
+        Slopes generated analytically along with the heights are used when
+        available. Otherwise they are read from storage or taken from the
+        analytic gradient of the heightmap by deriveSlopes(), so every slope
+        has the same definition and the GeoMip does not need to be generated
+        first. Only eroded heights get finite difference slopes.
+
+        """
+        store = self.world.regionStore
+        # maps derived from pruned heights are only kept in memory
+        persist = not self.octaveDetail
+        if store and persist:
+            pos = (self.xOffset, self.yOffset)
+            saved = store.read(pos, SLOPE_LAYER)
+            if self.slopes is None:
+                self.slopes = saved
+            if self.slopes is None:
+                self.slopes = self.deriveSlopes()
+            if saved is None:
+                store.write(pos, SLOPE_LAYER, self.slopes)
+            self.slopeMap = arrayToImage(self.slopes[::-1])
+            return
 
-        self.slopeMap = PNMImage()
-        if SAVED_SLOPE_MAPS:
-            fileName = "maps/slope/" + self.name + ".png"
+        fileName = "maps/slope/" + self.name + ".png"
+        if SAVED_SLOPE_MAPS and persist and self.slopes is None:
+            self.slopeMap = PNMImage()
             if self.slopeMap.read(Filename(fileName)):
                 logging.info( "read slopemap from " + fileName)
                 return
 
-        self.slopeMap = PNMImage(self.terrain.heightMapSize, self.terrain.heightMapSize)
-        self.slopeMap.makeGrayscale()
-        self.slopeMap.setMaxval(65535)
-
-        size = self.slopeMap.getYSize()
-        getNormal = self.getNormal
-        setGray = self.slopeMap.setGray
-
-        for x in range(size):
-            for y in range(size):
-                #note getNormal works at the same resolution as the heightmap
-                normal = getNormal(x, y)
-                #  feed pixel into image
-                # why is it necessary to invert the y axis I wonder?
-                #logging.info( normal)
-                normal.z /= self.terrain.getSz()
-                normal.normalize()
-                slope = 1.0 - normal.dot(Vec3(0, 0, 1))
-                setGray(x, y, slope)
-
-        if SAVED_SLOPE_MAPS:
-            fileName = "maps/slope/" + self.name + ".png"
+        if self.slopes is None:
+            self.slopes = self.deriveSlopes()
+        self.slopeMap = arrayToImage(self.slopes[::-1])
+
+        if SAVED_SLOPE_MAPS and persist:
             logging.info( "saving slopemap to " + fileName)
             self.slopeMap.write(Filename(fileName))
 
+    def getMemorySize(self):
+        """Returns roughly how many bytes the tile holds.
+
+        This counts the sample arrays, the images and the geometry and
+        textures of the tile and its statics.
+
+        """
+        size = 0
+        for array in (self.heights, self.slopes):
+            if array is not None:
+                size += array.nbytes
+        images = [self.image, getattr(self, "slopeMap", None)]
+        images.extend(getattr(self, "textureMaps", ()))
+        for image in images:
+            if image is not None:
+                # panda stores 16 bit channels
+                size += image.getXSize() * image.getYSize() * image.getNumChannels() * 2
+        analyzer = SceneGraphAnalyzer()
+        analyzer.addNode(self.getRoot().node())
+        size += analyzer.getVertexDataSize() + analyzer.getTextureBytes()
+        return size
+
+    def destroy(self):
+        """Frees the geometry, images and statics of a tile no longer used."""
+
+        if hasattr(self, "statics"):
+            self.statics.removeNode()
+        self.getRoot().removeNode()
+        self.image.clear()
+        if getattr(self, "slopeMap", None) is not None:
+            self.slopeMap.clear()
+        for image in getattr(self, "textureMaps", ()):
+            image.clear()
+        self.heights = None
+        self.slopes = None
+        if self.holdsBorders:
+            self.world.releaseTileBorders(self.xOffset, self.yOffset)
+            self.holdsBorders = False
 
     def createGroups(self):
         self.statics = self.getRoot().attachNewNode(self.name + "_statics")
@@ -187,14 +346,19 @@ class TerrainTile(GeoMipTerrain):
 
         self.statics.setShaderAuto()
 
-    @pstat
     def make(self):
         """Build a finished renderable heightMap."""
 
-        # apply shader
-        #logging.info( "applying shader")
-        self.terrain.texturer.apply(self.getRoot())
+        self.prepare()
+        self.commit()
 
+    @pstat
+    def prepare(self):
+        """Computes the heights, images and object placements of the tile.
+
+        Only the tile's own data is changed, so this can run on any thread.
+
+        """
         # detail settings
         #self.getRoot().setSx(1.0 / self.heightMapDetail)
         #self.getRoot().setSy(1.0 / self.heightMapDetail)
@@ -207,14 +371,27 @@ class TerrainTile(GeoMipTerrain):
 
         #http://www.panda3d.org/forums/viewtopic.php?t=12054
         self.calcAmbientOcclusion()
+        self.placements = self.terrain.populator.placeObjects(self)
+
+    @pstat
+    def commit(self):
+        """Builds the GeoMip and statics of a prepared tile.
+
+        This creates scene graph nodes, so it is done on the main thread.
+
+        """
+        # apply shader
+        #logging.info( "applying shader")
+        self.terrain.texturer.apply(self.getRoot())
         #logging.info( "generate()")
         self.generate()
-        self.getRoot().setCollideMask(BitMask32.bit(1)) 
+        self.getRoot().setCollideMask(BitMask32.bit(1))
 
-        #self.makeSlopeMap()
         #logging.info( "createGroups()")
         self.createGroups()
-        self.terrain.populator.populate(self)
+        self.terrain.populator.addObjects(self, self.placements)
+        self.placements = None
+        self.committed = True
 
 
 ###############################################################################
@@ -225,19 +402,21 @@ class LodTerrainTile(TerrainTile):
     """Always builds full detail heightmap, but uses panda3d's default LOD
     functions, and hides seams between tiles."""
 
-    def __init__(self, terrain, x, y):
+    def __init__(self, terrain, x, y, world=None):
         """Builds a Tile for the terrain at input coordinates."""
 
-        TerrainTile.__init__(self, terrain, x, y)
+        TerrainTile.__init__(self, terrain, x, y, world)
         self.detail = 3
         self.setMinLevel(3)
 
-    def make(self):
-        TerrainTile.make(self)
-
     def getDetail(self):
         return self.detail
 
+    def needsRefinement(self):
+        """Returns True if the current detail shows octaves the heights lack."""
+
+        return self.octaveDetail > self.detail
+
     def setDetail(self, detail):
         if self.detail == detail:
             return
@@ -249,6 +428,58 @@ class LodTerrainTile(TerrainTile):
         #self.getRoot().setPos(self.xOffset, self.yOffset, 0)
 
 
+###############################################################################
+#   CoarseTerrainTile
+###############################################################################
+
+class CoarseTerrainTile(TerrainTile):
+    """A low resolution stand-in shown while the full tile is being built.
+
+    It samples the heightmap only every few units, skips ambient occlusion
+    and population, and is replaced as soon as the full tile is ready.
+
+    """
+
+    def __init__(self, terrain, x, y, samples, world=None):
+        """Builds a Tile with samples + 1 heights along each side."""
+
+        TerrainTile.__init__(self, terrain, x, y, world)
+        self.heightMapDetail = float(samples) / terrain.tileSize
+        GeoMipTerrain.setBruteforce(self, True)
+        GeoMipTerrain.setBlockSize(self, samples + 1)
+        self.getRoot().setSx(1.0 / self.heightMapDetail)
+        self.getRoot().setSy(1.0 / self.heightMapDetail)
+
+    def prepare(self):
+        spacing = 0.0
+        if PRUNE_FAR_OCTAVES:
+            spacing = 1.0 / self.heightMapDetail
+        self.heights = generateHeights(self.world.getGridHeights, self.xOffset,
+                                       self.yOffset, self.terrain.tileSize,
+                                       self.heightMapDetail, spacing)
+        self.image = arrayToImage(self.heights[::-1])
+        self.setHeight()
+
+    def commit(self):
+        self.terrain.texturer.apply(self.getRoot())
+        self.generate()
+        self.getRoot().setCollideMask(BitMask32.bit(1))
+        self.committed = True
+
+    def getElevation(self, x, y):
+        d = self.heightMapDetail
+        return GeoMipTerrain.getElevation(self, x * d, y * d)
+
+    def getDetail(self):
+        return 0
+
+    def needsRefinement(self):
+        return True
+
+    def setDetail(self, detail):
+        """A coarse tile only has one detail level."""
+
+
 ###############################################################################
 #   LodTerrainTile2 !! UNUSED !!
 ###############################################################################
@@ -299,68 +530,134 @@ class LodTerrainTile2(NodePath):
 class TextureMappedTerrainTile(LodTerrainTile):
     """This terrain tile stores a pnm image map of textures to use."""
 
-    def __init__(self, terrain, x, y):
+    def __init__(self, terrain, x, y, world=None):
 
-        LodTerrainTile.__init__(self, terrain, x, y)
+        LodTerrainTile.__init__(self, terrain, x, y, world)
 
         # this sort of thing should really be done in c++
         self.textureMaps = deque()
         self.fourChannel = True
+        self.needsSlopes = True
 
-    def make(self):
-        TerrainTile.make(self)
+    def prepare(self):
+        TerrainTile.prepare(self)
         self.makeSlopeMap()
+        if self.world.regionStore:
+            self.makeArchivedTextureMaps()
+        else:
+            self.makeTextureMaps()
+
+    def commit(self):
+        TerrainTile.commit(self)
+        #load textureMaps as actual textures for the shaders use
+        num = 0
+        for tex in self.textureMaps:
+            num += 1
+            newTexture = Texture()
+            newTexture.load(tex)
+            ts = TextureStage('alp' + str(num))
+            self.getRoot().setTexture(ts, newTexture)
+        #logging.info( self.getRoot().findAllTextureStages())
+
+    def makeTextureMaps(self):
+        """Reads or calculates the texture maps as individual images."""
+
         textureMapper = self.terrain.texturer.textureMapper
+        # maps derived from pruned heights are only kept in memory
+        persist = not self.octaveDetail
 
         #try to read textureMaps
-        readTexMaps = True
+        images = []
         texNum = 0
         for tex in textureMapper.textures:
             texNum += 1
             fileName = "maps/textures/" + self.name + "+_texture" + str(texNum) + ".png"
-            if not tex.image.read(Filename(fileName)):
-                readTexMaps = False
-
-        #otherwise calculate textureMaps
-        if not readTexMaps:
-            self.terrain.texturer.textureMapper.calculateTextures(self)
+            image = PNMImage()
+            if persist and image.read(Filename(fileName)):
+                images.append(image)
+        if persist and len(images) == len(textureMapper.textures):
+            self.textureMaps.extend(images)
+            return
 
-        #copy textureMaps to this terrainTile and save if necessary
+        #otherwise calculate textureMaps and save them
+        # tiles may be prepared on several threads, so the weights are
+        # calculated into images of this tile rather than those of the mapper
+        if self.slopes is None:
+            # the slope map was read from a file
+            self.slopes = self.deriveSlopes()
+        # texture map rows follow the heightmap and slope map images
+        weights = textureMapper.calculateTextureWeights(self.heights[::-1], self.slopes[::-1])
         texNum = 0
-        for tex in self.terrain.texturer.textureMapper.textures:
+        for weight in weights:
             texNum += 1
-            self.textureMaps.append(tex.image)
-            if not readTexMaps:
-                tex.image.write(Filename("maps/textures/" + self.name + "+_texture" + str(texNum) + ".png"))
+            image = arrayToImage(weight)
+            image.makeRgb()
+            self.textureMaps.append(image)
+            if persist:
+                image.write(Filename("maps/textures/" + self.name + "+_texture" + str(texNum) + ".png"))
 
-        #load textureMaps as actual textures for the shaders use
-        num = 0
-        for tex in self.textureMaps:
-            num += 1
-            newTexture = Texture()
-            newTexture.load(tex)
-            ts = TextureStage('alp' + str(num))
-            self.getRoot().setTexture(ts, newTexture)
-        #logging.info( self.getRoot().findAllTextureStages())
+    def makeArchivedTextureMaps(self):
+        """Reads or calculates the texture maps in the terrain's region store."""
+
+        store = self.world.regionStore
+        pos = (self.xOffset, self.yOffset)
+        textureMapper = self.terrain.texturer.textureMapper
+        layers = range(TEXTURE_LAYER, TEXTURE_LAYER + len(textureMapper.textures))
+        # maps derived from pruned heights are only kept in memory
+        persist = not self.octaveDetail
+        weights = [None]
+        if persist:
+            weights = [store.read(pos, layer) for layer in layers]
+        if any(weight is None for weight in weights):
+            # texture map rows follow the heightmap and slope map images
+            weights = textureMapper.calculateTextureWeights(self.heights[::-1],
+                                                            self.slopes[::-1])
+            if persist:
+                for layer, weight in zip(layers, weights):
+                    store.write(pos, layer, weight)
+
+        for weight in weights:
+            image = arrayToImage(weight)
+            image.makeRgb()
+            self.textureMaps.append(image)
 
     
 ###############################################################################
 #  makeTile
 ###############################################################################
-def makeTile(threadName, terrain, pos):
+def makeTile(threadName, terrain, pos, heights=None, slopes=None, octaveDetail=None,
+             world=None):
+    """Returns a prepared tile, which the main thread must commit.
+
+    The tile is made for world, the terrain's current world by default.
+
+    """
+
     tile = pos
     logging.info( threadName+ " is instancing the tile at"+ str(pos))
     if SAVED_TEXTURE_MAPS:
-        tile = TextureMappedTerrainTile(terrain, pos[0], pos[1])
+        tile = TextureMappedTerrainTile(terrain, pos[0], pos[1], world)
     else:
-        tile = LodTerrainTile(terrain, pos[0], pos[1])
+        tile = LodTerrainTile(terrain, pos[0], pos[1], world)
+    tile.heights = heights
+    tile.slopes = slopes
+    if octaveDetail is None:
+        octaveDetail = terrain.getOctaveDetail(pos)
+    tile.octaveDetail = octaveDetail
     logging.info( threadName+ " is building the tile at"+ str(pos))
-    tile.make()
+    tile.prepare()
 #                self.terrain.populator.populate(tile)
     logging.info( threadName+ " finished the tile at"+ str(pos))
     return tile
 
     
+def makeCoarseTile(threadName, terrain, pos):
+    logging.info( threadName+ " is making a coarse tile at"+ str(pos))
+    tile = CoarseTerrainTile(terrain, pos[0], pos[1], COARSE_TILE_SIZE)
+    tile.prepare()
+    return tile
+
+    
 ###############################################################################
 #  PermanentTileBuilderThread
 ###############################################################################
@@ -394,6 +691,109 @@ class TransientTileBuilderThread(threading.Thread):
             tile = makeTile(self.getName(), self.terrain, self.pos)
             self.out_queue.put(tile)
           
+###############################################################################
+#  TileBuildQueue
+###############################################################################
+
+# the world of a request to rebuild a coarse or pruned tile in full
+REFINE = "refine"
+
+class TileBuildQueue():
+    """A thread safe queue of tile requests, closest to the focus first.
+
+    It has the same get(), put(), get_nowait(), empty() and qsize() methods
+    as a Queue.Queue. Requests can be cancelled, and are reordered by
+    distance to the nearest focus whenever setFocus() is called. A request is a (pos, world) tuple,
+    where world None stands for the terrain's current world. Requests with
+    world REFINE come after every other request, so a builder blocked in
+    get() wakes for refinements but still builds missing tiles first.
+
+    """
+
+    def __init__(self, tileSize):
+
+        self.center = tileSize * 0.5
+        self.foci = []
+        self.heap = []
+        # the current entry of each queued request
+        self.entries = {}
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def _priority(self, request):
+        pos = request[0]
+        priority = None
+        for x, y in self.foci:
+            deltaX = x - (pos[0] + self.center)
+            deltaY = y - (pos[1] + self.center)
+            distance = deltaX * deltaX + deltaY * deltaY
+            if priority is None or distance < priority:
+                priority = distance
+        return (request[1] is REFINE, priority or 0.0)
+
+    def put(self, pos, world=None):
+        with self.condition:
+            # the count keeps equally distant positions first in, first out
+            self.count += 1
+            request = (pos, world)
+            entry = (self._priority(request), self.count, request)
+            self.entries[request] = entry
+            heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    def get(self, block=True):
+        """Returns the queued (pos, world) request closest to the focus."""
+
+        with self.condition:
+            while True:
+                while self.heap:
+                    entry = heapq.heappop(self.heap)
+                    request = entry[2]
+                    # cancelled and reordered entries are left in the heap
+                    if self.entries.get(request) is entry:
+                        del self.entries[request]
+                        return request
+                if not block:
+                    raise Queue.Empty
+                self.condition.wait()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def cancel(self, pos, world=None):
+        """Removes pos from the queue if it is still waiting."""
+
+        with self.condition:
+            self.entries.pop((pos, world), None)
+
+    def cancelWorld(self, world=None):
+        """Removes every waiting request for world and returns their positions."""
+
+        with self.condition:
+            requests = [request for request in self.entries if request[1] is world]
+            for request in requests:
+                del self.entries[request]
+            return [pos for pos, world in requests]
+
+    def setFocus(self, foci):
+        """Orders the queue by distance to the nearest of foci, a list of
+        (x, y) positions."""
+
+        with self.condition:
+            self.foci = list(foci)
+            self.heap = [(self._priority(request), count, request)
+                         for priority, count, request in self.entries.values()]
+            heapq.heapify(self.heap)
+            self.entries = dict((entry[2], entry) for entry in self.heap)
+
+    def qsize(self):
+        with self.condition:
+            return len(self.entries)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
 ###############################################################################
 #  TerrainTileBuilder
 ###############################################################################
@@ -401,9 +801,11 @@ class TransientTileBuilderThread(threading.Thread):
 class TerrainTileBuilder():
 
     def __init__(self, terrain):
-        self.queue = Queue.Queue()
+        self.queue = TileBuildQueue(terrain.tileSize)
         self.out_queue = Queue.Queue()
         self.terrain = terrain
+        # the world of each request in flight in the generator pool
+        self.poolWorlds = deque()
         self.numTransients = 0
 
         #spawn a pool of threads, and pass them queue instance
@@ -418,31 +820,59 @@ class TerrainTileBuilder():
 #            #except:
 #            #logging.info( "Unable to start TileBuilderThread!")
 
-        taskMgr.setupTaskChain('tileBuilder', numThreads = 1, tickClock = False,
+        # tiles are prepared on the builder threads and committed to the
+        # scene graph by the terrain on the main thread
+        threads = max(1, TILE_BUILDER_THREADS)
+        if terrain.generatorPool:
+            # the pool has its own processes and is used from one thread
+            threads = 1
+        taskMgr.setupTaskChain('tileBuilder', numThreads = threads, tickClock = False,
                            threadPriority = None, frameBudget = -1,
                            frameSync = False, timeslicePriority = True)
 
-        taskMgr.add(self.makeTileTask, 'tileBuilderTask', taskChain = 'tileBuilder')
+        for i in range(threads):
+            taskMgr.add(self.makeTileTask, 'tileBuilderTask' + str(i),
+                        taskChain = 'tileBuilder')
 
-    def clearQueue(self):
-        return
-        while self.queue.qsize() > 2:
-            try:
-                pos = self.queue.get_nowait()
-                if pos in self.terrain.tiles:
-                    del self.terrain.tiles[pos]
-            except:
-                logging.info( "Unable to remove old tile from TileBuilder Queue")
+    def clearQueue(self, world=None):
+        """Cancels every tile waiting to be built for world.
+
+        world None cancels the tiles of the terrain's current world.
+
+        """
+        for pos in self.queue.cancelWorld(world):
+            if world is None and self.terrain.tiles.get(pos) == 1:
+                del self.terrain.tiles[pos]
+        if world is None:
+            self.queue.cancelWorld(REFINE)
+
+    def cancel(self, pos):
+        """Stops pos from being built if it has not been started yet."""
+
+        self.queue.cancel(pos)
+
+    def setFocus(self, foci):
+        """Builds the queued tiles closest to any of the (x, y) foci first."""
+
+        self.queue.setFocus(foci)
 
     def preload(self, pos):
         #self.queue.put(pos)
         self.build(pos)
 
-    def build(self, pos):
+    def build(self, pos, world=None):
+        """Queues the tile at pos of world, the current world by default."""
+
         #self.clearQueue()
-        self.queue.put(pos)
+        self.queue.put(pos, world)
         #self.spawnTransientThread(pos)
 
+    def refine(self, pos):
+        """Queues the coarse or pruned tile at pos to be rebuilt in full
+        once every missing tile is built."""
+
+        self.queue.put(pos, REFINE)
+
 
     def grab(self):
         try:
@@ -459,8 +889,120 @@ class TerrainTileBuilder():
         t.start()
 
     def makeTileTask(self, task):
-        pos = self.queue.get()
-        if pos:
+        if self.terrain.generatorPool:
+            return self.makePooledTileTask(task)
+        pos, world = self.queue.get()
+        if world is REFINE:
+            # nothing new is wanted, so refine a coarse or pruned tile
+            current = self.takeRefinement(pos)
+            if current is None:
+                return Task.cont
+            octaveDetail = None
+            if current != 1 and not isinstance(current, CoarseTerrainTile):
+                # a pruned tile came closer, so build it with every octave
+                octaveDetail = 0
+            tile = makeTile("tileBuilderTaskChain", self.terrain, pos,
+                            octaveDetail=octaveDetail)
+            self.out_queue.put(tile)
+            return Task.cont
+        if world is not None:
+            # the tiles of a regenerated world are swapped in once all are done
+            self.out_queue.put(makeTile("tileBuilderTaskChain", self.terrain, pos,
+                                        world=world))
+        elif pos and COARSE_TILE_SIZE:
+            tile = makeCoarseTile("tileBuilderTaskChain", self.terrain, pos)
+            # queued for refinement here, so the terrain must not queue it again
+            tile.refining = True
+            self.out_queue.put(tile)
+            self.refine(pos)
+        elif pos:
             tile = makeTile("tileBuilderTaskChain", self.terrain, pos)
             self.out_queue.put(tile)
-        return Task.cont
\ No newline at end of file
+        return Task.cont
+
+    def makePooledTileTask(self, task):
+        """Keeps the generator processes busy and assembles their results.
+
+        Heights and slopes are computed by the terrain's TileGeneratorPool.
+        This thread only submits requests and builds the GeoMip.
+
+        """
+        terrain = self.terrain
+        pool = terrain.generatorPool
+        if not pool.pending():
+            # nothing in flight, so block until there is work to do
+            self.submitToPool(self.queue.get())
+        while pool.hasFreeSlot():
+            try:
+                request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.submitToPool(request)
+
+        if pool.pending():
+            pos, octaveDetail, heights, slopes = pool.collect()
+            tile = makeTile("tileBuilderTaskChain", terrain, pos, heights, slopes,
+                            octaveDetail, self.poolWorlds.popleft())
+            self.out_queue.put(tile)
+        return Task.cont
+
+    def takeRefinement(self, pos):
+        """Returns the tile at pos if it still needs refinement, else None.
+
+        A tile may be queued for refinement long before the builder gets to
+        it, by which time it may have been removed, or moved away so far that
+        its octaves are enough again. The tile stays marked as refining while
+        its replacement is built, so it is not queued twice.
+
+        """
+        current = self.terrain.tiles.get(pos)
+        if current is None:
+            # the tile was removed in the meantime
+            return None
+        if current != 1 and not current.needsRefinement():
+            current.refining = False
+            return None
+        return current
+
+    def submitToPool(self, request):
+        """Sends a (pos, world) request to the pool unless its heights are
+        already cached.
+
+        Tiles of a world other than the current one are built right away.
+
+        """
+        terrain = self.terrain
+        pos, world = request
+        if world is REFINE:
+            # a pruned tile came closer, so build it with every octave
+            if self.takeRefinement(pos) is not None:
+                terrain.generatorPool.submit(pos, terrain.world.heightMap, terrain.getSz(),
+                                             0, terrain.erosion)
+                self.poolWorlds.append(terrain.world)
+            return
+        if world is not None:
+            self.out_queue.put(makeTile("tileBuilderTaskChain", terrain, pos, world=world))
+            return
+        # the terrain may switch worlds while the request is in flight
+        world = terrain.world
+        octaveDetail = terrain.getOctaveDetail(pos)
+        heights = world.getCachedHeights(pos[0], pos[1])
+        if heights is not None:
+            octaveDetail = 0
+        elif octaveDetail:
+            heights = world.getCachedHeights(pos[0], pos[1], 1, octaveDetail)
+        if heights is None and COARSE_TILE_SIZE:
+            # the pool's result will replace this coarse tile, so the
+            # terrain must not queue it for refinement
+            coarse = makeCoarseTile("tileBuilderTaskChain", terrain, pos)
+            coarse.refining = True
+            self.out_queue.put(coarse)
+        if heights is not None:
+            slopes = world.getTileSlopes(pos[0], pos[1], heights, 1, octaveDetail)
+            tile = makeTile("tileBuilderTaskChain", terrain, pos, heights, slopes,
+                            octaveDetail, world)
+            self.out_queue.put(tile)
+            return
+        terrain.generatorPool.submit(pos, world.heightMap, terrain.getSz(), octaveDetail,
+                                     terrain.erosion)
+        self.poolWorlds.append(world)
\ No newline at end of file
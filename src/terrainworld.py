@@ -0,0 +1,246 @@
+"""
+terrainworld.py: This file contains the generated world shown by a Terrain.
+
+A TerrainWorld holds everything that depends on the seed: the HeightMap, the
+samples shared between its tiles and the region archives they are saved in.
+Every tile is built for one world, so the tiles of a new world can be built
+in the background while those of the old world are still shown.
+
+Neither this file nor the files it imports touch Panda3d or the config, so a
+TerrainWorld can also generate tile heights, slopes, texture weights and
+object placements on its own, in batch jobs and worker processes without a
+window:
+
+    world = TerrainWorld(1234, 128, 300.0, 0.3)
+    heights, slopes = world.getTileHeightsAndSlopes(0, 0)
+    weights = world.getTextureWeights(heights, slopes)
+"""
+__author__ = "Stephen Lujan"
+
+import logging
+
+from heightmap import HeightMap
+from tilecache import HeightSampleCache
+from tilecache import TileBorderCache
+from tilegenerator import calculateTextureWeights
+from tilegenerator import defaultTextureRegions
+from tilegenerator import generateHeights
+from tilegenerator import generateHeightsAndSlopes
+from tilegenerator import generateSlopes
+from tilegenerator import octaveSpacing
+from tilegenerator import placeObjects
+from tileregion import RegionStore
+
+
+###############################################################################
+#   TerrainWorld
+###############################################################################
+
+class TerrainWorld():
+    """The heightmap of one seed and the tile data generated from it.
+
+    Heights are in [0,1] and are scaled by maxHeight, waterHeight is a
+    multiplier of maxHeight. recipe builds the noisegraph of the HeightMap
+    and an optional Erosion is applied to every tile. A HeightCache may be
+    shared between worlds, maxError is the sparse noise error allowed in
+    world units.
+
+    """
+
+    def __init__(self, id, tileSize, maxHeight, waterHeight, recipe=None, erosion=None,
+                 heightCache=None, maxError=0.0):
+
+        logging.info("initializing world " + str(id) + "...")
+        self.id = id
+        self.tileSize = tileSize
+        self.maxHeight = maxHeight
+        self.waterHeight = waterHeight
+        self.erosion = erosion
+        self.heightCache = heightCache
+        self.heightMap = HeightMap(id, waterHeight + 0.03, maxError / maxHeight, recipe)
+        self.getHeight = self.heightMap.getHeight
+        self.getHeights = self.heightMap.getHeights
+        self.getHeightsAndGradients = self.heightMap.getHeightsAndGradients
+        self.getGridHeights = self.heightMap.getGridHeights
+        self.getGridHeightsAndGradients = self.heightMap.getGridHeightsAndGradients
+        self.heightSamples = HeightSampleCache(self.getHeights)
+        self.borderCache = TileBorderCache(tileSize)
+        self.regionStore = None
+
+    def openRegionStore(self, numLayers, directory="maps/regions"):
+        """Opens region archives for this world."""
+
+        self.closeRegionStore()
+        self.regionStore = RegionStore(directory, self.getTileParameters(),
+                                       self.tileSize, 1, numLayers)
+
+    def closeRegionStore(self):
+        if self.regionStore:
+            self.regionStore.close()
+        self.regionStore = None
+
+    def getCachedHeights(self, x, y, detail=1, octaveDetail=0):
+        """Returns cached heights of the tile at x, y or None.
+
+        octaveDetail selects heights generated without the octaves too fine
+        for that level of detail, 0 selects complete heights.
+
+        """
+        if self.heightCache is None:
+            return None
+        return self.heightCache.get(self._heightCacheKey(x, y, detail, octaveDetail))
+
+    def cacheHeights(self, x, y, detail, heights, octaveDetail=0):
+        if self.heightCache is not None:
+            self.heightCache.put(self._heightCacheKey(x, y, detail, octaveDetail), heights)
+
+    def getCachedSlopes(self, x, y, detail=1, octaveDetail=0):
+        """Returns cached slopes of the tile at x, y or None, see
+        getCachedHeights()."""
+
+        if self.heightCache is None:
+            return None
+        return self.heightCache.get(self._slopeCacheKey(x, y, detail, octaveDetail))
+
+    def cacheSlopes(self, x, y, detail, slopes, octaveDetail=0):
+        if self.heightCache is not None:
+            self.heightCache.put(self._slopeCacheKey(x, y, detail, octaveDetail), slopes)
+
+    def _heightCacheKey(self, x, y, detail, octaveDetail):
+        return (self.id, x, y, detail, octaveDetail, self.getTileParameters())
+
+    def _slopeCacheKey(self, x, y, detail, octaveDetail):
+        return self._heightCacheKey(x, y, detail, octaveDetail) + ("slopes",)
+
+    def getTileHeights(self, x, y, octaveDetail=0):
+        """Returns the heights of the tile at x, y as an array indexed [y, x].
+
+        Heights are taken from the HeightCache if possible. Complete heights
+        share their edges with the tiles around them.
+
+        """
+        heights = self.getCachedHeights(x, y, 1, octaveDetail)
+        if heights is not None:
+            return heights
+        heights = generateHeights(self.getGridHeights, x, y, self.tileSize, 1,
+                                  octaveSpacing(octaveDetail), self.erosion)
+        if not octaveDetail:
+            heights = self.shareTileBorders(x, y, heights)
+        else:
+            heights = self.stitchTileBorders(x, y, heights)
+        self.cacheHeights(x, y, 1, heights, octaveDetail)
+        return heights
+
+    def getTileHeightsAndSlopes(self, x, y, octaveDetail=0):
+        """Returns the heights and slopes of the tile at x, y.
+
+        Both come from one pass over the noise, the slopes from its analytic
+        gradient, see generateHeightsAndSlopes(). They are cached and share
+        their edges like the heights of getTileHeights().
+
+        """
+        heights = self.getCachedHeights(x, y, 1, octaveDetail)
+        if heights is not None:
+            return heights, self.getTileSlopes(x, y, heights, 1, octaveDetail)
+        heights, slopes = generateHeightsAndSlopes(self.getGridHeightsAndGradients, x, y,
+                                                   self.tileSize, self.maxHeight, 1,
+                                                   octaveSpacing(octaveDetail), self.erosion)
+        if not octaveDetail:
+            heights = self.shareTileBorders(x, y, heights)
+            slopes = self.shareTileSlopes(x, y, slopes)
+        else:
+            heights = self.stitchTileBorders(x, y, heights)
+        self.cacheHeights(x, y, 1, heights, octaveDetail)
+        self.cacheSlopes(x, y, 1, slopes, octaveDetail)
+        return heights, slopes
+
+    def shareTileBorders(self, x, y, heights, hold=False):
+        """Returns complete tile heights with the edges of the tiles around
+        them, see TileBorderCache.
+
+        A tile that shares its borders with hold set must pass its position
+        to releaseTileBorders() once it is no longer used.
+
+        """
+        return self.borderCache.exchange(x, y, heights, hold)
+
+    def stitchTileBorders(self, x, y, heights):
+        """Returns pruned tile heights with the complete edges of the tiles
+        around them, so no crack opens between levels of detail, see
+        TileBorderCache.stitch().
+
+        Eroded edges depend on the tiles next to them, so edges sampled
+        for eroded heights are not shared.
+
+        """
+        return self.borderCache.stitch(x, y, heights, self.getGridHeights,
+                                       self.erosion is None)
+
+    def shareTileSlopes(self, x, y, slopes):
+        """Returns the slopes of complete tile heights with the edges of the
+        tiles around them, see TileBorderCache.exchangeSlopes()."""
+
+        return self.borderCache.exchangeSlopes(x, y, slopes)
+
+    def releaseTileBorders(self, x, y):
+        self.borderCache.release(x, y)
+
+    def getTileSlopes(self, x, y, heights, detail=1, octaveDetail=0):
+        """Returns the slopes of the tile at x, y with the given heights.
+
+        Cached slopes are used if possible. Otherwise they are taken from the
+        analytic gradient of the heightmap, exactly like the slopes made by
+        getTileHeightsAndSlopes(), so it does not matter where the heights
+        came from. Eroded heights have no analytic gradient, so their slopes
+        are finite differences of the heights, taken across the seams using
+        samples of the neighboring tiles.
+
+        """
+        slopes = self.getCachedSlopes(x, y, detail, octaveDetail)
+        if slopes is not None:
+            return slopes
+        complete = detail == 1 and not octaveDetail
+        if not self.erosion:
+            slopes = generateHeightsAndSlopes(self.getGridHeightsAndGradients, x, y,
+                                              self.tileSize, self.maxHeight, detail,
+                                              octaveSpacing(octaveDetail))[1]
+        elif complete:
+            padded = self.borderCache.pad(x, y, heights)
+            slopes = generateSlopes(padded, self.maxHeight)[1:-1, 1:-1]
+        else:
+            slopes = generateSlopes(heights, self.maxHeight)
+        if complete:
+            slopes = self.shareTileSlopes(x, y, slopes)
+        self.cacheSlopes(x, y, detail, slopes, octaveDetail)
+        return slopes
+
+    def getTextureWeights(self, heights, slopes, textureRegions=None):
+        """Returns an array of weights for each texture of a tile.
+
+        textureRegions defaults to the regions of the terrain's textures,
+        see defaultTextureRegions().
+
+        """
+        if textureRegions is None:
+            textureRegions = defaultTextureRegions(self.waterHeight, self.maxHeight)
+        return calculateTextureWeights(heights, slopes, textureRegions, self.maxHeight)
+
+    def placeObjects(self, x, y, heights, averageNumbers, detail=1):
+        """Returns where objects go on the tile at x, y, see placeObjects().
+
+        The placements are seeded by the heightmap, so a tile gets the same
+        objects every time it is made.
+
+        """
+        # the seed the populator has always used
+        seed = int(self.getHeight(y * -2, x * -2) + 1 * 2147483647)
+        return placeObjects(heights, averageNumbers, seed, self.tileSize,
+                            self.waterHeight, detail)
+
+    def getTileParameters(self):
+        """Returns the parameters that determine the heights of a tile."""
+
+        parameters = self.heightMap.getParameters()
+        if self.erosion:
+            parameters += self.erosion.getParameters()
+        return parameters
@@ -0,0 +1,119 @@
+"""
+test_noisegraph.py: This file contains tests comparing the analytic
+gradients of the perlin noise and noise graphs with finite differences.
+
+Run them from src with python -m unittest test_noisegraph
+"""
+__author__ = "Stephen Lujan"
+
+import unittest
+
+import numpy
+
+from noisegraph import Blend
+from noisegraph import Clamp
+from noisegraph import Constant
+from noisegraph import Multiply
+from noisegraph import Noise
+from noisegraph import NoiseGraph
+from perlin import PerlinNoise2
+from perlin import StackedPerlinNoise2
+
+STEP = 1e-4
+TOLERANCE = 1e-5
+
+
+def randomPoints(count, size):
+    random = numpy.random.RandomState(0)
+    return random.uniform(-size, size, count), random.uniform(-size, size, count)
+
+
+def makeStackedPerlin(seed, scale=200.0, octaves=6):
+    noise = StackedPerlinNoise2()
+    for x in range(octaves):
+        noise.addLevel(PerlinNoise2(scale / 2 ** x, scale / 2 ** x, 256, seed + x),
+                       1 / 2.2 ** x)
+    return noise
+
+
+def finiteDifferences(function, xs, ys):
+    """Returns the central differences of function(xs, ys) in x and y."""
+
+    dx = (function(xs + STEP, ys) - function(xs - STEP, ys)) / (2 * STEP)
+    dy = (function(xs, ys + STEP) - function(xs, ys - STEP)) / (2 * STEP)
+    return dx, dy
+
+
+class TestPerlinGradients(unittest.TestCase):
+
+    def assertGradient(self, gradient, expected, scale):
+        # the error of the differences grows with the curvature of the noise
+        for value, reference in zip(gradient, expected):
+            self.assertTrue(numpy.allclose(value, reference, 0, TOLERANCE / scale))
+
+    def testPerlinNoise2(self):
+        xs, ys = randomPoints(500, 1000.0)
+        for scale in (3.0, 40.0, 250.0):
+            noise = PerlinNoise2(scale, scale * 1.5, 256, 7)
+            value, dx, dy = noise.noiseWithGradient(xs, ys)
+            self.assertTrue(numpy.allclose(value, noise.noise(xs, ys)))
+            self.assertGradient((dx, dy), finiteDifferences(noise.noise, xs, ys), scale)
+
+    def testStackedPerlinNoise2(self):
+        noise = makeStackedPerlin(3)
+        xs, ys = randomPoints(500, 1000.0)
+        value, dx, dy = noise.noiseWithGradient(xs, ys)
+        self.assertGradient((dx, dy), finiteDifferences(noise.noise, xs, ys), 6.25)
+
+    def testGridNoise(self):
+        noise = makeStackedPerlin(11)
+        xs = numpy.arange(-20.0, 20.0, 1.5)
+        ys = numpy.arange(100.0, 130.0, 1.5)
+        value, dx, dy = noise.gridNoise(xs, ys, gradient=True)
+        x, y = numpy.meshgrid(xs, ys)
+        self.assertGradient((dx, dy), finiteDifferences(noise.noise, x, y), 6.25)
+
+
+class TestNoiseGraphGradients(unittest.TestCase):
+
+    def assertMatchesDifferences(self, graph, xs, ys):
+        value, dx, dy = graph.getValuesAndGradients(xs, ys)
+        self.assertTrue(numpy.allclose(value, graph.getValues(xs, ys)))
+        expected = finiteDifferences(graph.getValues, xs, ys)
+        self.assertTrue(numpy.allclose(dx, expected[0], 0, TOLERANCE))
+        self.assertTrue(numpy.allclose(dy, expected[1], 0, TOLERANCE))
+
+    def testArithmetic(self):
+        # built like HeightMap's default recipe
+        low = (Noise(makeStackedPerlin(20)) + 1) * 0.5
+        high = low * (Noise(makeStackedPerlin(40, 100.0)) + 1) * 0.5
+        graph = NoiseGraph(Blend(low, high, Clamp(low * 4 - 1)) * 300.0)
+        xs, ys = randomPoints(500, 1000.0)
+        self.assertMatchesDifferences(graph, xs, ys)
+
+    def testMultiplyByZero(self):
+        # the first factor is exactly 0 at the sample but not flat there, so
+        # the product rule still gives a gradient of da * b
+        first = makeStackedPerlin(5)
+        xs, ys = numpy.array([123.4]), numpy.array([-56.7])
+        a = Noise(first) - Constant(first.noise(xs, ys)[0])
+        b = Noise(makeStackedPerlin(9)) + 2
+        graph = NoiseGraph(Multiply(a, b))
+        value, dx, dy = graph.getValuesAndGradients(xs, ys)
+        self.assertEqual(value[0], 0.0)
+        self.assertNotEqual(dx[0], 0.0)
+        self.assertMatchesDifferences(graph, xs, ys)
+
+    def testGridMatchesPoints(self):
+        graph = NoiseGraph(Noise(makeStackedPerlin(30)) * Noise(makeStackedPerlin(50)))
+        xs = numpy.arange(0.0, 40.0, 2.0)
+        ys = numpy.arange(-40.0, 0.0, 2.0)
+        grid = graph.getGridValuesAndGradients(xs, ys)
+        x, y = numpy.meshgrid(xs, ys)
+        points = graph.getValuesAndGradients(x, y)
+        for gridValue, pointValue in zip(grid, points):
+            self.assertTrue(numpy.allclose(gridValue, pointValue))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+test_perlin.py: This file contains tests comparing the numpy perlin noise
+with Panda3d's.
+
+The tests are skipped when panda3d is not installed. Run them from src with
+python -m unittest test_perlin
+"""
+__author__ = "Stephen Lujan"
+
+import unittest
+
+import numpy
+
+from perlin import PerlinNoise2
+from perlin import StackedPerlinNoise2
+
+try:
+    from panda3d.core import PerlinNoise2 as PandaPerlinNoise2
+    from panda3d.core import StackedPerlinNoise2 as PandaStackedPerlinNoise2
+except ImportError:
+    PandaPerlinNoise2 = None
+
+TOLERANCE = 1e-9
+
+
+def randomPoints(count, size):
+    random = numpy.random.RandomState(0)
+    return random.uniform(-size, size, count), random.uniform(-size, size, count)
+
+
+@unittest.skipIf(PandaPerlinNoise2 is None, "panda3d is not installed")
+class TestPerlinNoise2(unittest.TestCase):
+
+    def testMatchesPanda(self):
+        xs, ys = randomPoints(1000, 3000.0)
+        for seed, scale in ((5, 1.0), (1, 37.5), (77, 300.0), (1234, 0.7)):
+            panda = PandaPerlinNoise2(scale, scale, 256, seed)
+            expected = [panda.noise(x, y) for x, y in zip(xs, ys)]
+            noise = PerlinNoise2(scale, scale, 256, seed)
+            self.assertTrue(numpy.allclose(noise.noise(xs, ys), expected, 0, TOLERANCE))
+
+    def testScalarMatchesPanda(self):
+        panda = PandaPerlinNoise2(20.0, 30.0, 256, 11)
+        noise = PerlinNoise2(20.0, 30.0, 256, 11)
+        self.assertAlmostEqual(noise.noise(-123.4, 56.7), panda.noise(-123.4, 56.7), 9)
+
+
+@unittest.skipIf(PandaPerlinNoise2 is None, "panda3d is not installed")
+class TestStackedPerlinNoise2(unittest.TestCase):
+
+    def testMatchesPanda(self):
+        # built like HeightMap.generateStackedPerlin()
+        panda = PandaStackedPerlinNoise2()
+        noise = StackedPerlinNoise2()
+        for x in range(8):
+            scale = 200.0 / 2 ** x
+            amp = 1 / 2.2 ** x
+            panda.addLevel(PandaPerlinNoise2(scale, scale, 256, 100 + x), amp)
+            noise.addLevel(PerlinNoise2(scale, scale, 256, 100 + x), amp)
+        xs, ys = randomPoints(1000, 3000.0)
+        expected = [panda.noise(x, y) for x, y in zip(xs, ys)]
+        self.assertTrue(numpy.allclose(noise.noise(xs, ys), expected, 0, TOLERANCE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,570 @@
+"""
+tilecache.py: This file contains caches for generated terrain tile data.
+
+The HeightCache keeps recently generated tile heightfields in memory so tiles
+that come back into range can skip noise evaluation entirely.
+
+The TileStorage keeps detached tiles that may come back into range, within a
+memory budget.
+
+The HeightSampleCache memoizes heightmap samples for elevation queries that
+fall outside of any resident tile.
+
+The TileBorderCache shares the samples along tile edges, keeping the seams
+between neighboring tiles identical and giving slopes a halo of samples.
+
+Height files persist tile heightfields on disk in a compact binary format. A
+header records the seed, tile size, detail and a hash of the HeightMap
+parameters so files made by a different generator are rejected, and the
+samples can be used straight from the buffer they were read into.
+"""
+__author__ = "Stephen Lujan"
+
+import hashlib
+import logging
+import math
+import numpy
+import struct
+import threading
+
+from collections import OrderedDict
+from tilegenerator import interpolateHeight
+from tilegenerator import interpolateHeights
+
+
+###############################################################################
+#   HeightCache
+###############################################################################
+
+class HeightCache():
+    """A least recently used cache of tile height arrays with a byte budget.
+
+    Arrays are stored as read only float32, which is more precise than the
+    16 bit heightmap images built from them. The hits, misses and evictions
+    counters can be used to size the budget.
+
+    """
+
+    def __init__(self, maxBytes):
+
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        # tiles may be built on the main thread and the tileBuilder thread
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached array for key or None."""
+
+        with self.lock:
+            heights = self.entries.pop(key, None)
+            if heights is None:
+                self.misses += 1
+                return None
+            self.entries[key] = heights
+            self.hits += 1
+            return heights
+
+    def put(self, key, heights):
+        """Stores an array, evicting the least recently used as necessary."""
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                # already cached, just mark it as recently used
+                self.entries[key] = old
+                return
+
+        heights = numpy.array(heights, numpy.float32)
+        heights.flags.writeable = False
+        if heights.nbytes > self.maxBytes:
+            return
+        with self.lock:
+            if not key in self.entries:
+                self.size += heights.nbytes
+            self.entries[key] = heights
+            while self.size > self.maxBytes:
+                key, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+###############################################################################
+#   TileStorage
+###############################################################################
+
+class TileStorage():
+    """A least recently used store of detached tiles with a byte budget.
+
+    Every tile is stored with its size in bytes. When the total exceeds
+    maxBytes the least recently stored tiles are removed and passed to
+    evicted(pos, tile), which should free their resources. Tiles are only
+    stored and recovered on the main thread.
+
+    """
+
+    def __init__(self, maxBytes, evicted=None):
+
+        self.maxBytes = maxBytes
+        self.evicted = evicted
+        self.size = 0
+        self.evictions = 0
+        # pos: (tile, size)
+        self.entries = OrderedDict()
+
+    def __contains__(self, pos):
+        return pos in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, pos):
+        """Returns the tile stored at pos or None, leaving it stored."""
+
+        entry = self.entries.get(pos)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def pop(self, pos):
+        """Removes and returns the tile stored at pos or None."""
+
+        entry = self.entries.pop(pos, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+    def put(self, pos, tile, size):
+        """Stores a tile, evicting the least recently stored as necessary."""
+
+        replaced = self.pop(pos)
+        if replaced is not None and replaced is not tile and self.evicted:
+            self.evicted(pos, replaced)
+        self.entries[pos] = (tile, size)
+        self.size += size
+        while self.size > self.maxBytes and self.entries:
+            self._evict()
+
+    def _evict(self):
+        pos, (tile, size) = self.entries.popitem(last=False)
+        self.size -= size
+        self.evictions += 1
+        if self.evicted:
+            self.evicted(pos, tile)
+
+    def clear(self):
+        """Evicts every stored tile."""
+
+        while self.entries:
+            self._evict()
+
+
+def groupByCell(cellXs, cellYs):
+    """Yields each distinct cell of integer arrays with the indices in it.
+
+    The indices are those of the flattened arrays.
+
+    """
+    cellXs = numpy.ravel(cellXs)
+    cellYs = numpy.ravel(cellYs)
+    if not len(cellXs):
+        return
+    cells = numpy.stack((cellXs, cellYs), axis=1)
+    unique, inverse = numpy.unique(cells, axis=0, return_inverse=True)
+    order = numpy.argsort(inverse.ravel(), kind="mergesort")
+    bounds = numpy.searchsorted(inverse.ravel()[order], numpy.arange(len(unique) + 1))
+    for i in range(len(unique)):
+        yield int(unique[i, 0]), int(unique[i, 1]), order[bounds[i]:bounds[i + 1]]
+
+
+###############################################################################
+#   HeightSampleCache
+###############################################################################
+
+class HeightSampleCache():
+    """Answers height queries from memoized chunks of heightmap samples.
+
+    Samples are taken on the same integer grid as the tiles and evaluated a
+    chunk at a time with a batch height function, so heights match those of
+    a tile and the noise is never evaluated twice for the same sample while
+    its chunk stays cached.
+
+    """
+
+    def __init__(self, getHeights, chunkSize=16, maxChunks=256):
+
+        self.sampleHeights = getHeights
+        self.chunkSize = chunkSize
+        self.maxChunks = maxChunks
+        self.chunks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def getChunk(self, chunkX, chunkY):
+        """Returns the samples of a chunk as an array indexed [y, x]."""
+
+        key = (chunkX, chunkY)
+        with self.lock:
+            chunk = self.chunks.pop(key, None)
+            if chunk is not None:
+                self.chunks[key] = chunk
+                return chunk
+
+        size = self.chunkSize
+        coordinates = numpy.arange(size + 1)
+        xs, ys = numpy.meshgrid(coordinates + chunkX * size, coordinates + chunkY * size)
+        chunk = self.sampleHeights(xs, ys)
+        with self.lock:
+            self.chunks[key] = chunk
+            while len(self.chunks) > self.maxChunks:
+                self.chunks.popitem(last=False)
+        return chunk
+
+    def getHeight(self, x, y):
+        """Returns the height at x, y interpolated between cached samples."""
+
+        size = self.chunkSize
+        chunkX = int(math.floor(x / size))
+        chunkY = int(math.floor(y / size))
+        chunk = self.getChunk(chunkX, chunkY)
+        return interpolateHeight(chunk, x - chunkX * size, y - chunkY * size)
+
+    def getHeights(self, xs, ys):
+        """Returns the heights at arrays of coordinates, one chunk at a time."""
+
+        shape = numpy.shape(xs)
+        xs = numpy.ravel(numpy.asarray(xs, numpy.float64))
+        ys = numpy.ravel(numpy.asarray(ys, numpy.float64))
+        size = self.chunkSize
+        chunkXs = numpy.floor(xs / size).astype(numpy.int64)
+        chunkYs = numpy.floor(ys / size).astype(numpy.int64)
+        heights = numpy.empty(xs.shape)
+        for chunkX, chunkY, points in groupByCell(chunkXs, chunkYs):
+            chunk = self.getChunk(chunkX, chunkY)
+            heights[points] = interpolateHeights(chunk, xs[points] - chunkX * size,
+                                                 ys[points] - chunkY * size)
+        return heights.reshape(shape)
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+
+
+###############################################################################
+#   TileBorderCache
+###############################################################################
+
+class TileBorderCache():
+    """Shares the samples along tile edges between neighboring tiles.
+
+    Entries are keyed by edge: (x, y, True) for the column of samples at x
+    starting at y, (x, y, False) for the row at y starting at x. Each holds
+    the line of samples on the edge under 0, and the lines next to it under
+    -1 (west or south) and 1 (east or north) when they are known, and the
+    slopes on the edge under "slope". Lines next to an edge that pad()
+    sampled because no tile there was made yet are provisional, and are kept
+    under ("sampled", side) until the tile there exchanges its own line.
+    Corners are keyed (x, y) and hold their single sample under 0 and their
+    slope under "slope".
+
+    The first tile to reach an edge stores its samples and every later tile
+    adopts them, so the seam between two tiles is bit identical even when
+    their heights were interpolated from sparse noise. The lines next to an
+    edge give slopes a halo of samples without evaluating the noise again.
+
+    A tile exchanging its heights with hold set keeps its edges cached until
+    it calls release(), so every tile in use shares its seams exactly. The
+    edges no tile holds are kept up to maxEdges, least recently used first
+    out. A tile made after the edges of a neighbor that is no longer held
+    were evicted generates that edge again, which may differ from the saved
+    or cached heights of the neighbor by up to twice the sparse noise error.
+    Once the neighbor is made again it adopts the new edge.
+
+    """
+
+    def __init__(self, tileSize, maxEdges=2048):
+
+        self.tileSize = tileSize
+        self.maxEdges = maxEdges
+        # least recently used entries of edges no tile holds
+        self.edges = OrderedDict()
+        # entries of held edges and how many tiles hold each
+        self.heldEdges = {}
+        self.holds = {}
+        self.lock = threading.Lock()
+
+    def getTileEdges(self, x, y):
+        """Returns the edges of the tile at x, y.
+
+        Each edge is its key, the index of its line in the tile, and the side
+        of the edge the tile is on.
+
+        """
+        size = self.tileSize
+        return (((x, y, True), 0, 1), ((x + size, y, True), size, -1),
+                ((x, y, False), 0, 1), ((x, y + size, False), size, -1))
+
+    def getTileCorners(self, x, y):
+        """Returns the corners of the tile at x, y as (key, xIndex, yIndex)."""
+
+        size = self.tileSize
+        return [((x + xIndex, y + yIndex), xIndex, yIndex)
+                for xIndex, yIndex in ((0, 0), (size, 0), (0, size), (size, size))]
+
+    def _getEntry(self, key, hold=False):
+        # the lock must be held
+        entry = self.heldEdges.get(key)
+        if entry is None:
+            entry = self.edges.pop(key, None)
+            if entry is None:
+                entry = {}
+            if hold:
+                self.heldEdges[key] = entry
+            else:
+                self.edges[key] = entry
+                self._evict()
+        if hold:
+            self.holds[key] = self.holds.get(key, 0) + 1
+        return entry
+
+    def _evict(self):
+        # the lock must be held
+        while len(self.edges) > self.maxEdges:
+            self.edges.popitem(last=False)
+
+    def exchange(self, x, y, heights, hold=False):
+        """Returns the heights of the tile at x, y with the edges it shares.
+
+        Edges already cached replace those of heights, which is copied
+        first. The other edges are cached from heights. The lines of heights
+        next to its edges always replace those cached, which may have been
+        sampled by pad(). With hold set the edges stay cached until release()
+        is called for the tile.
+
+        """
+        with self.lock:
+            heights = self._share(x, y, heights, 0, hold)
+            for key, index, side in self.getTileEdges(x, y):
+                column = key[2]
+                inner = heights[:, index + side] if column else heights[index + side]
+                entry = self._getEntry(key)
+                entry[side] = numpy.array(inner)
+                entry.pop(("sampled", side), None)
+        return heights
+
+    def exchangeSlopes(self, x, y, slopes):
+        """Returns the slopes of the tile at x, y with the edges it shares.
+
+        This works like exchange() for the slopes of complete heights, so
+        the slopes on both sides of a seam match as well. The edges are held
+        along with those of the heights.
+
+        """
+        with self.lock:
+            return self._share(x, y, slopes, "slope")
+
+    def _share(self, x, y, samples, name, hold=False):
+        # the lock must be held
+        for key, index, side in self.getTileEdges(x, y):
+            column = key[2]
+            entry = self._getEntry(key, hold)
+            line = samples[:, index] if column else samples[index]
+            edge = entry.get(name)
+            if edge is None:
+                entry[name] = numpy.array(line)
+            elif not numpy.array_equal(edge, line):
+                if not samples.flags.writeable:
+                    samples = numpy.array(samples)
+                if column:
+                    samples[:, index] = edge
+                else:
+                    samples[index] = edge
+        # edges cached by diagonal neighbors may disagree at the corners
+        for key, xIndex, yIndex in self.getTileCorners(x, y):
+            entry = self._getEntry(key, hold)
+            corner = entry.setdefault(name, samples[yIndex, xIndex])
+            if corner != samples[yIndex, xIndex]:
+                if not samples.flags.writeable:
+                    samples = numpy.array(samples)
+                samples[yIndex, xIndex] = corner
+        return samples
+
+    def stitch(self, x, y, heights, getGridHeights, cache=True):
+        """Returns pruned heights of the tile at x, y with complete edges.
+
+        Pruned heights lack the finest octaves, so their edges would not
+        meet those of neighbors with more octaves. Cached edges replace those
+        of heights, which is copied first, and the missing edges are sampled
+        with every octave by getGridHeights. The samples are cached unless
+        cache is False, so a complete neighbor made later adopts them. Pruned
+        heights never cache their own edges, nor the lines next to them.
+
+        """
+        heights = numpy.array(heights)
+        size = len(heights)
+        coordinates = numpy.arange(size)
+        for key, index, side in self.getTileEdges(x, y):
+            column = key[2]
+            with self.lock:
+                edge = self._getEntry(key).get(0)
+            if edge is None:
+                if column:
+                    edge = getGridHeights(numpy.array([key[0]]), coordinates + y, 0.0)[:, 0]
+                else:
+                    edge = getGridHeights(coordinates + x, numpy.array([key[1]]), 0.0)[0]
+                if cache:
+                    with self.lock:
+                        edge = self._getEntry(key).setdefault(0, edge)
+            if column:
+                heights[:, index] = edge
+            else:
+                heights[index] = edge
+        with self.lock:
+            for key, xIndex, yIndex in self.getTileCorners(x, y):
+                corner = self._getEntry(key).get(0)
+                if corner is not None:
+                    heights[yIndex, xIndex] = corner
+        return heights
+
+    def pad(self, x, y, heights, getGridHeights=None):
+        """Returns the heights of the tile at x, y with a border of samples.
+
+        The border is taken from the neighboring tiles through the cache.
+        Missing lines are sampled with a grid height function and cached as
+        provisional until the neighbor is made, or copied from the edge when
+        getGridHeights is None. The corners of the border are left 0.
+
+        """
+        size = len(heights)
+        padded = numpy.zeros((size + 2, size + 2))
+        padded[1:-1, 1:-1] = heights
+        coordinates = numpy.arange(size)
+        for key, index, side in self.getTileEdges(x, y):
+            column = key[2]
+            with self.lock:
+                entry = self._getEntry(key)
+                outer = entry.get(-side)
+                if outer is None:
+                    outer = entry.get(("sampled", -side))
+            if outer is None and getGridHeights is None:
+                outer = heights[:, index] if column else heights[index]
+            elif outer is None:
+                position = numpy.array([(key[0] if column else key[1]) - side])
+                if column:
+                    outer = getGridHeights(position, coordinates + y, 0.0)[:, 0]
+                else:
+                    outer = getGridHeights(coordinates + x, position, 0.0)[0]
+                with self.lock:
+                    entry = self._getEntry(key)
+                    if not -side in entry:
+                        entry[("sampled", -side)] = outer
+            if column:
+                padded[1:-1, index + 1 - side] = outer
+            else:
+                padded[index + 1 - side, 1:-1] = outer
+        return padded
+
+    def release(self, x, y):
+        """Lets the edges held by the tile at x, y be evicted again."""
+
+        keys = [edge[0] for edge in self.getTileEdges(x, y)]
+        keys.extend(corner[0] for corner in self.getTileCorners(x, y))
+        with self.lock:
+            for key in keys:
+                count = self.holds.get(key)
+                if count is None:
+                    # the cache was cleared in the meantime
+                    continue
+                if count > 1:
+                    self.holds[key] = count - 1
+                    continue
+                del self.holds[key]
+                self.edges[key] = self.heldEdges.pop(key)
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.edges.clear()
+            self.heldEdges.clear()
+            self.holds.clear()
+
+
+###############################################################################
+#   Height files
+###############################################################################
+
+HEIGHT_FILE_MAGIC = b"PTHM"
+HEIGHT_FILE_VERSION = 1
+# magic, version, sample format, seed, tile size, detail, samples per side,
+# parameter hash
+HEIGHT_FILE_HEADER = struct.Struct("<4sHHqIII8s")
+# sample formats and the little endian dtypes they are stored as
+HEIGHT_FILE_FORMATS = {0: numpy.dtype("<u2"), 1: numpy.dtype("<f4")}
+UINT16_FORMAT = 0
+FLOAT32_FORMAT = 1
+
+def hashParameters(parameters):
+    """Returns a stable 8 byte digest of a tuple of generator parameters."""
+
+    return hashlib.md5(repr(parameters).encode("ascii")).digest()[:8]
+
+def writeHeightFile(fileName, heights, parameters, tileSize, detail,
+                    sampleFormat=UINT16_FORMAT):
+    """Writes a heights array indexed [y, x] with values in [0,1] to a file."""
+
+    heights = numpy.asarray(heights)
+    if sampleFormat == UINT16_FORMAT:
+        samples = numpy.clip(heights * 65535 + 0.5, 0, 65535)
+    else:
+        samples = heights
+    samples = numpy.ascontiguousarray(samples, HEIGHT_FILE_FORMATS[sampleFormat])
+    header = HEIGHT_FILE_HEADER.pack(HEIGHT_FILE_MAGIC, HEIGHT_FILE_VERSION,
+                                     sampleFormat, parameters[0], tileSize,
+                                     detail, heights.shape[0],
+                                     hashParameters(parameters))
+    with open(fileName, "wb") as f:
+        f.write(header)
+        samples.tofile(f)
+
+def readHeightFile(fileName, parameters, tileSize, detail):
+    """Returns the heights stored in a file, or None.
+
+    None is returned if the file is missing, damaged or was written for
+    different generator parameters, tile size or detail.
+
+    """
+    try:
+        with open(fileName, "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+    if len(data) < HEIGHT_FILE_HEADER.size:
+        return None
+
+    magic, version, sampleFormat, seed, fileTileSize, fileDetail, size, \
+        parameterHash = HEIGHT_FILE_HEADER.unpack_from(data)
+    if magic != HEIGHT_FILE_MAGIC or version != HEIGHT_FILE_VERSION:
+        logging.info("ignoring unrecognized height file " + fileName)
+        return None
+    if (seed != parameters[0] or fileTileSize != tileSize or fileDetail != detail
+        or parameterHash != hashParameters(parameters)):
+        logging.info("ignoring stale height file " + fileName)
+        return None
+
+    dtype = HEIGHT_FILE_FORMATS.get(sampleFormat)
+    if dtype is None or len(data) != HEIGHT_FILE_HEADER.size + size * size * dtype.itemsize:
+        logging.info("ignoring damaged height file " + fileName)
+        return None
+    samples = numpy.frombuffer(data, dtype, size * size, HEIGHT_FILE_HEADER.size)
+    samples = samples.reshape(size, size)
+    if sampleFormat == UINT16_FORMAT:
+        return samples * (1.0 / 65535)
+    return samples
@@ -0,0 +1,333 @@
+"""
+tilegenerator.py: This file contains the data side of terrain tile generation.
+
+These functions turn a HeightMap and a tile position into plain numpy arrays
+of heights, slopes and texture weights, and into object placements. They
+never touch Panda3d, so the TileGeneratorPool can run them in worker
+processes and hand the arrays back through shared memory, leaving only the
+GeoMip construction to the Panda3d side.
+"""
+__author__ = "Stephen Lujan"
+
+import logging
+import multiprocessing
+import numpy
+
+from collections import deque
+from heightmap import HeightMap
+from multiprocessing.sharedctypes import RawArray
+from perlin import Mersenne
+
+
+###############################################################################
+#   Tile data functions
+###############################################################################
+
+def octaveSpacing(octaveDetail):
+    """Returns the vertex spacing of a brute force tile at a level of detail.
+
+    Level 0 returns 0, which keeps every octave of the noise.
+
+    """
+    if octaveDetail <= 0:
+        return 0.0
+    return float(2 ** octaveDetail)
+
+def generateHeights(getGridHeights, xOffset, yOffset, tileSize, detail=1, spacing=0.0,
+                    erosion=None):
+    """Returns the heights of a tile as an array indexed [y, x].
+
+    getGridHeights is a grid height function such as
+    HeightMap.getGridHeights(). spacing is passed on to it to skip octaves
+    too fine to be rendered. An Erosion is applied to the heights together
+    with a halo of neighboring samples, so tiles stay seamless.
+
+    """
+    if erosion:
+        return generateErodedHeights(getGridHeights, xOffset, yOffset, tileSize,
+                                     detail, spacing, erosion)[1:-1, 1:-1]
+    heightMapSize = tileSize * detail + 1
+    coordinates = numpy.arange(heightMapSize) / float(detail)
+    return getGridHeights(coordinates + xOffset, coordinates + yOffset, spacing)
+
+def generateHeightsAndSlopes(getGridHeightsAndGradients, xOffset, yOffset, tileSize,
+                             verticalScale, detail=1, spacing=0.0, erosion=None):
+    """Returns the heights and slopes of a tile as arrays indexed [y, x].
+
+    Slopes come from the analytic gradient returned with the heights by a
+    function such as HeightMap.getGridHeightsAndGradients(). Eroded heights
+    have no analytic gradient, so their slopes are taken from the samples.
+
+    """
+    if erosion:
+        def getGridHeights(xs, ys, spacing):
+            return getGridHeightsAndGradients(xs, ys, spacing)[0]
+        heights = generateErodedHeights(getGridHeights, xOffset, yOffset, tileSize,
+                                        detail, spacing, erosion)
+        return heights[1:-1, 1:-1], generateSlopes(heights, verticalScale)[1:-1, 1:-1]
+
+    heightMapSize = tileSize * detail + 1
+    coordinates = numpy.arange(heightMapSize) / float(detail)
+    heights, dx, dy = getGridHeightsAndGradients(coordinates + xOffset,
+                                                 coordinates + yOffset, spacing)
+    return heights, gradientsToSlopes(dx, dy, verticalScale, detail)
+
+def generateErodedHeights(getGridHeights, xOffset, yOffset, tileSize, detail,
+                          spacing, erosion):
+    """Returns eroded tile heights with a border of one extra sample."""
+
+    halo = erosion.getHalo()
+    heightMapSize = tileSize * detail + 1
+    coordinates = (numpy.arange(heightMapSize + halo * 2) - halo) / float(detail)
+    heights = getGridHeights(coordinates + xOffset, coordinates + yOffset, spacing)
+    heights = erosion.erode(heights)
+    border = halo - 1
+    return heights[border:heights.shape[0] - border, border:heights.shape[1] - border]
+
+def gradientsToSlopes(dx, dy, verticalScale, detail=1):
+    """Returns slopes from height derivatives per world unit.
+
+    This is the exact counterpart of generateSlopes(), which approximates
+    the same derivatives with finite differences between samples.
+
+    """
+    # the slope of the geomip is measured per sample, not per world unit
+    nx = numpy.asarray(dx) / detail
+    ny = numpy.asarray(dy) / detail
+    nz = 1.0 / verticalScale
+    return 1.0 - nz / numpy.sqrt(nx * nx + ny * ny + nz * nz)
+
+def generateSlopes(heights, verticalScale):
+    """Returns the slopes of a heightfield as an array indexed [y, x].
+
+    A slope is 0 where the terrain is flat and approaches 1 where it is
+    vertical. Derivatives are taken between neighboring samples the same
+    way GeoMipTerrain.getNormal() does, including clamping at the edges.
+
+    """
+    ySize, xSize = heights.shape
+    x = numpy.arange(xSize)
+    y = numpy.arange(ySize)
+    left = numpy.maximum(x - 1, 0)
+    right = numpy.minimum(x + 1, xSize - 1)
+    down = numpy.maximum(y - 1, 0)
+    up = numpy.minimum(y + 1, ySize - 1)
+
+    nx = (heights[:, left] - heights[:, right]) * 0.5
+    ny = (heights[up, :] - heights[down, :]) * 0.5
+    nz = 1.0 / verticalScale
+    return 1.0 - nz / numpy.sqrt(nx * nx + ny * ny + nz * nz)
+
+def interpolateHeight(heights, x, y):
+    """Returns the height bilinearly interpolated at sample coordinates x, y.
+
+    Coordinates outside the array are clamped to its edges.
+
+    """
+    ySize, xSize = heights.shape
+    x = min(max(x, 0.0), xSize - 1.0)
+    y = min(max(y, 0.0), ySize - 1.0)
+    x0 = min(int(x), xSize - 2)
+    y0 = min(int(y), ySize - 2)
+    fx = x - x0
+    fy = y - y0
+    row0 = heights[y0]
+    row1 = heights[y0 + 1]
+    low = row0[x0] + (row0[x0 + 1] - row0[x0]) * fx
+    high = row1[x0] + (row1[x0 + 1] - row1[x0]) * fx
+    return float(low + (high - low) * fy)
+
+def interpolateHeights(heights, xs, ys):
+    """Returns heights bilinearly interpolated at arrays of sample coordinates.
+
+    This is the batch version of interpolateHeight().
+
+    """
+    ySize, xSize = heights.shape
+    xs = numpy.clip(numpy.asarray(xs, numpy.float64), 0.0, xSize - 1.0)
+    ys = numpy.clip(numpy.asarray(ys, numpy.float64), 0.0, ySize - 1.0)
+    x0 = numpy.minimum(xs.astype(numpy.int64), xSize - 2)
+    y0 = numpy.minimum(ys.astype(numpy.int64), ySize - 2)
+    fx = xs - x0
+    fy = ys - y0
+    h00 = heights[y0, x0]
+    h10 = heights[y0, x0 + 1]
+    h01 = heights[y0 + 1, x0]
+    h11 = heights[y0 + 1, x0 + 1]
+    low = h00 + (h10 - h00) * fx
+    high = h01 + (h11 - h01) * fx
+    return low + (high - low) * fy
+
+def defaultTextureRegions(waterHeight, maxHeight):
+    """Returns the regions of the terrain's textures.
+
+    There is a list of regions for each texture: dirt, grass, rock and snow.
+    A region is a (min height, max height, min slope, max slope) tuple, with
+    heights in world units like the heights scaled by maxHeight.
+
+    """
+    water = waterHeight * maxHeight
+    def indexToHeight(index):
+        # maps [0.0, 1.0] to [water, maxHeight]
+        return index * (maxHeight - water) + water
+
+    return [[(-9999.0, indexToHeight(0.1), -0.001, 1.001)],
+            [(indexToHeight(-0.15), indexToHeight(0.75), -0.001, 0.30)],
+            [(indexToHeight(0.1), indexToHeight(0.95), 0.10, 1.001),
+             # forces tex 2 and 4 to blend a bit at their boundries regardless of slope
+             (indexToHeight(0.4), indexToHeight(0.9), -0.001, 1.001)],
+            [(indexToHeight(0.72), 9999.0, -0.001, 1.001)]]
+
+def calculateTextureWeights(heights, slopes, textureRegions, maxHeight):
+    """Returns an array of weights for each texture.
+
+    heights in [0,1] are scaled by maxHeight. textureRegions holds a list of
+    regions for each texture, see defaultTextureRegions(). The weights of a
+    texture add up over its regions, and the weights of all textures add up
+    to 1 wherever any region applies.
+
+    """
+    heights = numpy.asarray(heights) * maxHeight
+    slopes = numpy.asarray(slopes)
+    weights = []
+    textureWeightTotal = 0.000001
+
+    for regions in textureRegions:
+        weight = numpy.zeros(heights.shape)
+        for limits in regions:
+            heightWeight = numpy.minimum(limits[1] - heights, heights - limits[0])
+            slopeWeight = numpy.minimum(limits[3] - slopes, slopes - limits[2])
+            weight += numpy.maximum(heightWeight, 0) * numpy.maximum(slopeWeight, 0)
+        weights.append(weight)
+        textureWeightTotal = textureWeightTotal + weight
+
+    return [weight / textureWeightTotal for weight in weights]
+
+def placeObjects(heights, averageNumbers, seed, tileSize, waterHeight, detail=1):
+    """Returns where objects go on a tile as (kind, x, y) tuples.
+
+    averageNumbers holds the average number of objects of each kind on a
+    tile, and kind is an index into it. x and y are relative to the tile
+    origin and objects are only placed above waterHeight. The placements
+    depend on nothing but the arguments, so a tile gets the same objects in
+    any process.
+
+    The numbers drawn are those of Panda3d's RandomNumGen(seed).random(),
+    so tiles keep the objects the populator used to give them.
+
+    """
+    dice = Mersenne(int(seed))
+    def random():
+        return dice.getUint31() / float(1 << 31)
+
+    placements = []
+    for kind, averageNumber in enumerate(averageNumbers):
+        num = int((random() + random()) * averageNumber)
+        for iterator in range(num):
+            x = random() * tileSize
+            y = random() * tileSize
+            if interpolateHeight(heights, x * detail, y * detail) > waterHeight:
+                placements.append((kind, x, y))
+    return placements
+
+
+###############################################################################
+#   Worker process functions
+###############################################################################
+
+# state of a worker process, set up once by _initWorker
+_worker = {}
+
+def _initWorker(sharedArray, shape):
+    _worker['buffer'] = numpy.frombuffer(sharedArray, numpy.float64).reshape(shape)
+    _worker['heightMaps'] = {}
+
+def _getHeightMap(id, flatHeight, maxError, recipe):
+    """Returns a HeightMap for the parameters, reusing it between tiles."""
+
+    key = (id, flatHeight, maxError, recipe)
+    heightMaps = _worker['heightMaps']
+    if not key in heightMaps:
+        heightMaps.clear()
+        heightMaps[key] = HeightMap(id, flatHeight, maxError, recipe)
+    return heightMaps[key]
+
+def _generateTile(slot, id, flatHeight, maxError, recipe, x, y, tileSize,
+                  verticalScale, spacing, erosion):
+    """Writes the heights and slopes of a tile into a shared memory slot."""
+
+    heightMap = _getHeightMap(id, flatHeight, maxError, recipe)
+    heights, slopes = generateHeightsAndSlopes(heightMap.getGridHeightsAndGradients,
+                                               x, y, tileSize, verticalScale,
+                                               spacing=spacing, erosion=erosion)
+    buffer = _worker['buffer']
+    buffer[slot, 0] = heights
+    buffer[slot, 1] = slopes
+    return slot
+
+
+###############################################################################
+#   TileGeneratorPool
+###############################################################################
+
+class TileGeneratorPool():
+    """Generates tile heights and slopes in a pool of worker processes.
+
+    Results are written into a fixed number of slots of a shared memory
+    buffer, so only a slot number is pickled back to this process. Requests
+    are collected in the order they were submitted. A pool must only be used
+    from one thread at a time.
+
+    """
+
+    def __init__(self, tileSize, processes, slotsPerProcess=2):
+
+        heightMapSize = tileSize + 1
+        self.tileSize = tileSize
+        self.shape = (processes * slotsPerProcess, 2, heightMapSize, heightMapSize)
+        sharedArray = RawArray('d', int(numpy.prod(self.shape)))
+        self.buffer = numpy.frombuffer(sharedArray, numpy.float64).reshape(self.shape)
+        self.freeSlots = deque(range(self.shape[0]))
+        self.inFlight = deque()
+
+        logging.info("starting " + str(processes) + " tile generator processes")
+        self.pool = multiprocessing.Pool(processes, _initWorker, (sharedArray, self.shape))
+
+    def hasFreeSlot(self):
+        return len(self.freeSlots) > 0
+
+    def pending(self):
+        """Returns the number of submitted requests not yet collected."""
+
+        return len(self.inFlight)
+
+    def submit(self, pos, heightMap, verticalScale, octaveDetail=0, erosion=None):
+        """Starts generating the tile at pos. A free slot is required.
+
+        Octaves too fine for the level of detail octaveDetail are skipped,
+        and an optional Erosion is applied in the worker.
+
+        """
+        slot = self.freeSlots.popleft()
+        args = (slot, heightMap.id, heightMap.flatHeight, heightMap.maxError,
+                heightMap.recipe, pos[0], pos[1], self.tileSize, verticalScale,
+                octaveSpacing(octaveDetail), erosion)
+        result = self.pool.apply_async(_generateTile, args)
+        self.inFlight.append((pos, octaveDetail, result))
+
+    def collect(self):
+        """Waits for the oldest request.
+
+        Returns its pos, octaveDetail, heights and slopes.
+
+        """
+        pos, octaveDetail, result = self.inFlight.popleft()
+        slot = result.get()
+        heights = self.buffer[slot, 0].copy()
+        slopes = self.buffer[slot, 1].copy()
+        self.freeSlots.append(slot)
+        return pos, octaveDetail, heights, slopes
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
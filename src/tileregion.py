@@ -0,0 +1,188 @@
+"""
+tileregion.py: This file contains region archives for persisted tile data.
+
+A RegionArchive packs the data of REGION_SIZE x REGION_SIZE tiles into one
+file: heights, slopes and texture weights, each stored as a layer of float32
+samples. The file is memory mapped, so reading a layer returns a zero copy
+numpy view and a cold start only touches a few large files instead of
+thousands of small images.
+
+    File layout:
+header (see REGION_HEADER)
+index, one (record offset, layer mask) pair per tile slot, offset 0 if absent
+records, each holding every layer of one tile
+"""
+__author__ = "Stephen Lujan"
+
+import logging
+import mmap
+import numpy
+import os
+import struct
+import threading
+
+from tilecache import hashParameters
+
+REGION_SIZE = 32
+REGION_MAGIC = b"PTRG"
+REGION_VERSION = 2
+# magic, version, region size, tile size, detail, samples per side,
+# number of layers, seed, parameter hash
+REGION_HEADER = struct.Struct("<4sHHIIIIq8s")
+REGION_INDEX_DTYPE = numpy.dtype([("offset", "<i8"), ("layers", "<u8")])
+
+# layers stored for each tile
+HEIGHT_LAYER = 0
+SLOPE_LAYER = 1
+TEXTURE_LAYER = 2 # the first texture weight layer, one per texture
+
+
+###############################################################################
+#   RegionArchive
+###############################################################################
+
+class RegionArchive():
+    """A single memory mapped file holding the layers of a block of tiles."""
+
+    def __init__(self, fileName, parameters, tileSize, detail, numLayers):
+
+        self.fileName = fileName
+        self.side = tileSize * detail + 1
+        self.numLayers = numLayers
+        self.layerBytes = self.side * self.side * 4
+        self.recordBytes = self.layerBytes * numLayers
+        self.indexOffset = REGION_HEADER.size
+        self.dataOffset = self.indexOffset + REGION_SIZE * REGION_SIZE * REGION_INDEX_DTYPE.itemsize
+        self.header = REGION_HEADER.pack(REGION_MAGIC, REGION_VERSION, REGION_SIZE,
+                                         tileSize, detail, self.side, numLayers,
+                                         parameters[0], hashParameters(parameters))
+        self.lock = threading.Lock()
+        self.map = None
+
+        if not self._isValid():
+            self._create()
+        self.file = open(fileName, "r+b")
+        self._remap()
+
+    def _isValid(self):
+        """Returns True if the file exists and matches our parameters."""
+
+        try:
+            with open(self.fileName, "rb") as f:
+                header = f.read(REGION_HEADER.size)
+            size = os.path.getsize(self.fileName)
+        except (IOError, OSError):
+            return False
+        if header != self.header or size < self.dataOffset:
+            logging.info("replacing stale region archive " + self.fileName)
+            return False
+        return True
+
+    def _create(self):
+        logging.info("creating region archive " + self.fileName)
+        with open(self.fileName, "wb") as f:
+            f.write(self.header)
+            numpy.zeros(REGION_SIZE * REGION_SIZE, REGION_INDEX_DTYPE).tofile(f)
+
+    def _remap(self):
+        # Views into an old map keep it alive, so it is never closed here.
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = numpy.frombuffer(self.map, REGION_INDEX_DTYPE,
+                                      REGION_SIZE * REGION_SIZE, self.indexOffset)
+
+    def read(self, slot, layer):
+        """Returns a read only [y, x] view of a tile layer, or None."""
+
+        with self.lock:
+            entry = self.index[slot]
+            if not entry["layers"] & (1 << layer):
+                return None
+            offset = int(entry["offset"]) + layer * self.layerBytes
+            view = numpy.frombuffer(self.map, numpy.float32, self.side * self.side, offset)
+        return view.reshape(self.side, self.side)
+
+    def write(self, slot, layer, samples):
+        """Stores a tile layer, allocating the tile's record if necessary."""
+
+        samples = numpy.ascontiguousarray(samples, numpy.float32)
+        with self.lock:
+            f = self.file
+            offset = int(self.index[slot]["offset"])
+            layers = int(self.index[slot]["layers"])
+            if offset == 0:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(b"\0" * self.recordBytes)
+            f.seek(offset + layer * self.layerBytes)
+            samples.tofile(f)
+            f.seek(self.indexOffset + slot * REGION_INDEX_DTYPE.itemsize)
+            entry = numpy.array([(offset, layers | (1 << layer))], REGION_INDEX_DTYPE)
+            entry.tofile(f)
+            f.flush()
+            if offset + self.recordBytes > len(self.map):
+                self._remap()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.map = None
+            self.index = None
+
+
+###############################################################################
+#   RegionStore
+###############################################################################
+
+class RegionStore():
+    """Maps tile positions to the region archives in a directory."""
+
+    def __init__(self, directory, parameters, tileSize, detail, numLayers):
+
+        self.directory = directory
+        self.parameters = parameters
+        self.tileSize = tileSize
+        self.detail = detail
+        self.numLayers = numLayers
+        self.regions = {}
+        self.lock = threading.Lock()
+
+    def locate(self, pos):
+        """Returns the region coordinates and slot of the tile at pos."""
+
+        tileX = int(pos[0]) // self.tileSize
+        tileY = int(pos[1]) // self.tileSize
+        region = (tileX // REGION_SIZE, tileY // REGION_SIZE)
+        slot = (tileY % REGION_SIZE) * REGION_SIZE + tileX % REGION_SIZE
+        return region, slot
+
+    def getRegion(self, region):
+        """Returns the archive for region coordinates, opening it if needed."""
+
+        with self.lock:
+            if not region in self.regions:
+                fileName = os.path.join(self.directory, "ID%d_R%d_%d.region"
+                                        % (self.parameters[0], region[0], region[1]))
+                self.regions[region] = RegionArchive(fileName, self.parameters,
+                                                     self.tileSize, self.detail,
+                                                     self.numLayers)
+            return self.regions[region]
+
+    def read(self, pos, layer):
+        region, slot = self.locate(pos)
+        return self.getRegion(region).read(slot, layer)
+
+    def write(self, pos, layer, samples):
+        region, slot = self.locate(pos)
+        self.getRegion(region).write(slot, layer, samples)
+
+    def preload(self, positions):
+        """Opens and maps the archives covering the tile positions."""
+
+        for region in set(self.locate(pos)[0] for pos in positions):
+            self.getRegion(region)
+
+    def close(self):
+        with self.lock:
+            for archive in self.regions.values():
+                archive.close()
+            self.regions.clear()